@@ -0,0 +1,84 @@
+import hashlib
+import logging
+import os
+import tempfile
+
+# Generated files end up on the web and in rsync mirrors, so only touch them
+# when their content actually changes, and never leave a half-written file
+# where a reader could see it.
+
+def content_hash(content):
+    return hashlib.sha256(content).hexdigest()
+
+
+def file_hash(path):
+    """
+    Hash of the file at `path`, or None if there isn't one.
+    """
+    if not os.path.exists(path):
+        return None
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def temp_path_for(path):
+    """
+    Make an empty temp file next to `path`, so renaming it over `path` stays
+    on the same filesystem and is atomic.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(dir=directory,
+            prefix="." + os.path.basename(path) + ".", suffix=".tmp")
+    os.close(fd)
+    return temp_path
+
+
+def replace_if_changed(temp_path, path):
+    """
+    Move the finished `temp_path` over `path` unless `path` already has the
+    same content, in which case the temp file is thrown away.
+
+    Returns whether `path` changed.
+    """
+    if file_hash(temp_path) == file_hash(path):
+        os.remove(temp_path)
+        logging.info(f"Not rewriting {path}, content identical")
+        return False
+
+    # mkstemp makes files only we can read, but these are usually published
+    if os.path.exists(path):
+        mode = os.stat(path).st_mode & 0o777
+    else:
+        mode = 0o644
+    os.chmod(temp_path, mode)
+    os.replace(temp_path, path)
+    logging.info(f"Wrote {path}")
+    return True
+
+
+def write_if_changed(path, content):
+    """
+    Write `content` (bytes or str) to `path` atomically, skipping the write
+    entirely if the file already holds exactly that content.
+
+    Returns whether `path` changed.
+    """
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    if content_hash(content) == file_hash(path):
+        logging.info(f"Not rewriting {path}, content identical")
+        return False
+
+    temp_path = temp_path_for(path)
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return replace_if_changed(temp_path, path)
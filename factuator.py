@@ -20,6 +20,8 @@ parser.add_argument('--studylibrary', help='Update study library', action='store
 parser.add_argument('--studyimporter', metavar="CSV", help='Create study pages from given tsv')
 parser.add_argument('--timeline', help='Create or update timeline page based on Category:Study, Category:Project, and Category:Grant', action='store_true')
 parser.add_argument('--studyreport', help='Generate CSV report about studies', action='store_true')
+parser.add_argument('--studyreport-format', choices=['csv', 'jsonl', 'parquet', 'sqlite'], help='Output format for --studyreport, can be given more than once (default csv)', action='append')
+parser.add_argument('--output-dir', help='Directory to write generated files for --timeline and --studyreport')
 parser.add_argument('--add-category', nargs=2, metavar=('category', 'match'), help='Add category `category` to pages with `match` in the title')
 parser.add_argument('--rename-category', nargs=2, metavar=('old', 'new'), help='Rename category `old` to `new`')
 parser.add_argument('--rename-regex', nargs=3, metavar=('match', 'regex', 'result'), help='Rename all pages with `match` in the title replacing `regex` with `result`')
@@ -27,6 +29,8 @@ parser.add_argument('--export-gdoc', nargs=5, metavar=('wiki_prefix', 'file_pref
 parser.add_argument('--export-gdoc-single', nargs=6, metavar=('wiki_prefix', 'file_prefix', 'http_prefix', 'drive_id', 'unsorted_folder_id', 'page_title'), help='Export single wiki page with `wiki_prefix` to google drive at `drive_id` creating unsorted folders in `unsorted_folder_id` for eventual gdocwiki use where `file_prefix` allows public-internet-visible viewing of files at `http_prefix` [EXPERIMENTAL]')
 parser.add_argument('--link-gdoc', nargs=4, metavar=('file_prefix', 'drive_id', 'files_folder_id', 'folder_id'), help='Walk folder with `folder_id` and repair links based on stored mappings [EXPERIMENTAL]')
 parser.add_argument('--link-gdoc-single', nargs=4, metavar=('file_prefix', 'drive_id', 'files_folder_id', 'doc_id'), help='Repair links in doc based on stored mappings [EXPERIMENTAL]')
+parser.add_argument('--two-phase', help='With --export-gdoc, create docs for all new pages before converting any, so links between them resolve in one pass', action='store_true')
+parser.add_argument('-j', '--jobs', type=int, default=4, help='How many pages to export or docs to relink in google docs at once (default 4)')
 parser.add_argument('-f', '--force', help='Force whatever changes instead of trying to be precise about updates', action='store_true')
 parser.add_argument('-n', '--older', metavar="ISO_DATE", help='Update pages not updated since a given date')
 parser.add_argument('-a', '--all', help='Run all known automated updates', action='store_true')
@@ -75,10 +79,10 @@ elif args.studylibrary:
     studylibrary.run(mother)
 elif args.timeline:
     import timeline
-    timeline.run(mother)
+    timeline.run(mother, args.output_dir)
 elif args.studyreport:
     import studyreport
-    studyreport.run(mother)
+    studyreport.run(mother, args.studyreport_format, args.output_dir or '.')
 elif args.add_category:
     import addcategory
     addcategory.run(mother, args.add_category[0], args.add_category[1])
@@ -96,13 +100,14 @@ elif args.all:
     import selfreportlibrary
     selfreportlibrary.run(mother)
     import timeline
-    timeline.run(mother)
+    timeline.run(mother, args.output_dir)
 elif args.export_gdoc:
     import gdocdriver
     gdocdriver.export_mediawiki(mother, args.export_gdoc[0],
             args.force, args.older,
             args.export_gdoc[1], args.export_gdoc[2],
-            args.export_gdoc[3], args.export_gdoc[4])
+            args.export_gdoc[3], args.export_gdoc[4],
+            workers=args.jobs, two_phase=args.two_phase)
 elif args.export_gdoc_single:
     import gdocdriver
     gdocdriver.export_mediawiki(mother, args.export_gdoc_single[0],
@@ -113,7 +118,8 @@ elif args.export_gdoc_single:
 elif args.link_gdoc:
     import gdocdriver
     gdocdriver.link_folder(mother, args.link_gdoc[0], args.link_gdoc[1],
-            args.link_gdoc[2], args.link_gdoc[3])
+            args.link_gdoc[2], args.link_gdoc[3],
+            workers=args.jobs, force=args.force)
 elif args.link_gdoc_single:
     import gdocdriver
     gdocdriver.link_doc(mother, args.link_gdoc_single[0], args.link_gdoc_single[1], 
@@ -5,8 +5,11 @@ import time
 import tempfile
 import socket
 import os
+import json
+import hashlib
 
 from enum import Enum
+from gdocrequests import flatten_requests, optimize_requests, chunk_requests
 
 FONT_SIZE_DEFAULT = 11
 FONT_SIZE_TABLE = 8
@@ -65,6 +68,18 @@ class NodeResponse:
 GOOGLE_DOCS_PREFIX = "https://docs.google.com/document/d/"
 GOOGLE_DRIVE_PREFIX = "https://drive.google.com/file/d/"
 
+# Bump this whenever a change here changes what gets written into docs, so
+# pages get converted again even if the wiki page hasn't changed
+CONVERTER_VERSION = 1
+
+
+def hash_requests(requests):
+    """
+    Stable hash of a Docs API request stream.
+    """
+    data = json.dumps(requests, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
 
 class GDocConverter:
     """
@@ -87,19 +102,21 @@ class GDocConverter:
         self.http_prefix = http_prefix
 
 
-    def convert(self, page, doc_id, debug=False):
+    def convert(self, page, doc_id, skip_unchanged=True, debug=False):
         """
         Convert content from a given `page` into a google document at `doc_id`.
 
         Passing `debug=True` will run requests one at a time, so you can see 
         the document getting created from the "bottom up" and debug API errors
+
+        With `skip_unchanged`, returns False without touching the doc if the
+        requests we would send are identical to the last ones we sent, see
+        `GDocMappings.exported`.
         """
 
         self.doc_id = doc_id
-
-        # If we were really fancy, we would try to do merging of content.
-        # But we're just going to brute force override old content.
-        self.clear_document()
+        # Titles we had to leave `wiki://` placeholders for
+        self.placeholders = set()
 
         # Note that the Google Docs API recommends that you "create
         # backwards" because of the indexes changing on edits.
@@ -113,14 +130,52 @@ class GDocConverter:
         requests.extend(self.wiki_markup_to_requests(oldtext))
 
         requests = list(reversed(requests))
-        flat_requests = []
-        for x in requests:
-            if isinstance(x, list):
-                flat_requests.extend(x)
-            else:
-                flat_requests.append(x)
+        flat_requests = optimize_requests(flatten_requests(requests))
 
-        self.driver.batch_update(self.doc_id, flat_requests, debug=debug)
+        request_hash = hash_requests(flat_requests)
+        if skip_unchanged and not debug and request_hash == self.mappings.get_export_hash(doc_id):
+            logging.info(f"Not updating doc {doc_id} for {page.name}, requests identical")
+            self.mappings.record_export(doc_id, page.revision, request_hash, CONVERTER_VERSION)
+            self.mappings.set_placeholders(doc_id, self.placeholders)
+            return False
+
+        # If we were really fancy, we would try to do merging of content.
+        # But we're just going to brute force override old content.
+        end_index, revision_id = self.driver.get_document_end(doc_id)
+        if debug:
+            requests = self.clear_requests(end_index) + flat_requests
+            self.driver.batch_update(self.doc_id, requests, debug=debug)
+        else:
+            self.send_chunks(page, flat_requests, request_hash, end_index, revision_id)
+        self.mappings.record_export(doc_id, page.revision, request_hash, CONVERTER_VERSION)
+        self.mappings.set_placeholders(doc_id, self.placeholders)
+        return True
+
+
+    def send_chunks(self, page, flat_requests, request_hash, end_index, revision_id):
+        """
+        Clear and refill the doc in bounded batchUpdates, so big pages
+        don't go over the API's payload limits.
+
+        Each chunk requires the revision the last one left, so someone
+        editing in between makes it fail instead of inserting at the wrong
+        place. Progress is saved after each chunk, and if the same export
+        gets interrupted, the next try picks up after the last chunk that
+        went through, as long as the doc hasn't changed since.
+        """
+        chunks = chunk_requests(flat_requests)
+        start = 0
+        progress = self.mappings.get_export_progress(self.doc_id)
+        if progress is not None and progress[0] == request_hash and progress[2] == revision_id:
+            start = progress[1]
+            logging.info(f"Resuming {page.name} at chunk {start + 1} of {len(chunks)}")
+        else:
+            chunks[0] = self.clear_requests(end_index) + chunks[0]
+
+        for n in range(start, len(chunks)):
+            revision_id = self.driver.update_chunk(self.doc_id, chunks[n], revision_id)
+            self.mappings.record_export_progress(self.doc_id, request_hash, n + 1, revision_id)
+        self.mappings.clear_export_progress(self.doc_id)
 
 
     def wiki_markup_to_requests(self, markup, start_index=1, status=None):
@@ -225,6 +280,8 @@ class GDocConverter:
                 url = GOOGLE_DOCS_PREFIX + doc_id + "/edit"
             else:
                 url = "wiki://" + title
+                if not "Category:" in title and not "File:" in title and not "Media:" in title:
+                    self.placeholders.add(title)
 
             text = self.node_to_text(node.text).strip()
             if not text:
@@ -266,8 +323,8 @@ class GDocConverter:
 
                     requests.append(self.insert_text(start_index, additional_text))
 
-                elif title in self.mappings.file_to_id:
-                    url = GOOGLE_DRIVE_PREFIX + self.mappings.file_to_id[title]
+                elif self.mappings.get_file_id(title) is not None:
+                    url = GOOGLE_DRIVE_PREFIX + self.mappings.get_file_id(title)
                     requests.append(self.insert_link(start_index, text, url))
 
                 else:
@@ -370,18 +427,20 @@ class GDocConverter:
         return status
 
 
-    def clear_document(self):
-        idxend = self.get_last_index()
+    def clear_requests(self, idxend):
+        """
+        Requests to delete everything in a doc whose body ends at `idxend`.
+        """
         if idxend <= 2:
             # Doc already empty
-            return
-        self.driver.batch_update(self.doc_id, [{
+            return []
+        return [{
             'deleteContentRange': {
                 'range': {
                     'startIndex': 1,
                     'endIndex': idxend-1,
                 }
-            }}])
+            }}]
 
 
     def insert_text(self, idx, text, status=None):
@@ -672,12 +731,6 @@ class GDocConverter:
         return self.driver.get_document(self.doc_id).get('body').get('content')
 
 
-    def get_last_index(self):
-        content = self.get_content()
-        last = content[-1]
-        return last['endIndex']
-
-
     def get_text_range(self, match_text):
         """
         Find `match_text` and return its start and end index.
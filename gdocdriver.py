@@ -3,27 +3,47 @@ import logging
 import requests
 import os
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pytz
 from datetime import datetime
 from dateutil import parser
 
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 
 from gdocmappings import GDocMappings 
-from gdocconverter import GDocConverter
+from gdocconverter import GDocConverter, CONVERTER_VERSION
 from gdoclinks import GDocLinks
+from gdocfolders import FolderTree
+from gdrivemirror import DriveMirror, DOCUMENT_MIME_TYPE
+from gdocsnapshots import DocSnapshots
+from wikibatch import query_titles
+from wikititles import TitleResolver
+from gdocratelimit import RateLimiter, is_rate_limited, is_transient, retry_after, DOCS_RATE, DRIVE_RATE, MAX_RETRIES
 
 SCOPES = ['https://www.googleapis.com/auth/documents',
           'https://www.googleapis.com/auth/drive',
           'https://www.googleapis.com/auth/drive.file',
           'https://www.googleapis.com/auth/drive.metadata']
-MAPPINGS_FILE = "mappings.google.json"
+MAPPINGS_FILE = "mappings.google.sqlite"
+# Mappings used to live in JSON, this gets imported the first time
+LEGACY_MAPPINGS_FILE = "mappings.google.json"
+MIRROR_FILE = "drive.google.sqlite"
+REDIRECTS_FILE = "redirects.wiki.json"
+SNAPSHOTS_FILE = "snapshots.google.sqlite"
 
-# Limit to how many parents to request via Drive API
-MAX_PARENTS = 500
+# How long to trust the saved wiki redirect map, in seconds
+REDIRECT_CACHE_TTL = 24 * 60 * 60
+
+# How many pages to convert at once
+DEFAULT_WORKERS = 4
+
+# Limit to how many requests go in one Drive batch request
+MAX_BATCH = 100
 
 class GDocDriver:
     """
@@ -34,7 +54,7 @@ class GDocDriver:
     updates on docs in a given folder
     """
 
-    def __init__(self, mappings_path, drive_id):
+    def __init__(self, mappings_path, drive_id, workers=DEFAULT_WORKERS):
         """
         GDocDriver needs a path to mappings. See `gdocmappings.py`.
 
@@ -44,49 +64,224 @@ class GDocDriver:
         `file_prefix` is used by the converter to store image and other
         files in a public-internet-accessible location so the Google Docs
         API can read them from `http_prefix`
+
+        `workers` is how many pages get converted at once. They all share
+        the same rate limiters, so this mostly hides API latency.
         """
 
-        self.mappings = GDocMappings(MAPPINGS_FILE)
+        self.mappings = GDocMappings(mappings_path, LEGACY_MAPPINGS_FILE)
+        self.workers = workers
+        self.local = threading.local()
+        self.docs_limiter = RateLimiter('docs', DOCS_RATE)
+        self.drive_limiter = RateLimiter('drive', DRIVE_RATE)
         self.initialize_google_services()
         self.drive_id = drive_id
+        self.mirror = DriveMirror(MIRROR_FILE, self, drive_id)
+        self.snapshots = DocSnapshots(SNAPSHOTS_FILE)
         self.folders = {}
+        self.folder_names = {}
+        self.tree = None
+        self.modified_dates = {}
+        self.stale_titles = set()
+        # Titles we made new docs for, see `relink_backlinks`
+        self.created_titles = []
+
+        # Drive metadata changes we send in batches
+        self.pending_lock = threading.Lock()
+        self.pending_reparents = {}
+        self.pending_tags = {}
 
 
-    def run_export(self, wiki, wiki_prefix, force, older, file_prefix, http_prefix, unsorted_folder_id, page_title):
+    def run_export(self, wiki, wiki_prefix, force, older, file_prefix, http_prefix, unsorted_folder_id, page_title, two_phase=False):
         """
         Function that does the conversion from mediawiki to gdoc,
         walking the mediawiki pages
+
+        With `two_phase`, docs for every unmapped page get created up front
+        by `reserve_docs`, so links between pages all resolve while
+        converting instead of needing a `--link-gdoc` pass.
         """
 
         self.wiki = wiki
+        self.load_title_resolver(wiki)
         self.wiki_prefix = wiki_prefix
         self.file_prefix = file_prefix
         self.http_prefix = http_prefix
         self.unsorted_folder_id = unsorted_folder_id
 
-        if page_title:
-            # We don't need to load common folders if the doc already exists
-            if not page_title in self.mappings.title_to_id:
-                self.load_common_folders()
-            self.convert_one(page_title)
-        else:
-            self.load_common_folders()
-            if force:
-                self.convert_all()
-            if older:
-                self.convert_all(older_than=older)
+        # New docs are already in mappings, so if they don't get moved and
+        # tagged before we stop, no later run will do it
+        try:
+            if page_title:
+                # We don't need to load common folders if the doc already exists
+                if not self.mappings.has_page(page_title):
+                    self.load_common_folders()
+                self.convert_one(page_title)
             else:
-                self.convert_all_new()
+                self.load_common_folders()
+                if two_phase:
+                    self.reserve_docs()
+                if force:
+                    self.convert_all()
+                if older:
+                    self.stale_titles = self.plan_stale_titles(older)
+                    self.convert_all(only_if_stale=True)
+                else:
+                    self.convert_all_new()
+
+            self.relink_backlinks()
+        finally:
+            self.flush_metadata()
+            self.mappings.save()
+
+
+    def relink_backlinks(self):
+        """
+        Fix up the placeholder links to docs created in this run. Asks the
+        wiki what links to each new title, and only relinks the docs for
+        those pages that actually hold a placeholder for it.
+        """
+        with self.pending_lock:
+            created = list(self.created_titles)
+            self.created_titles = []
+        if not created:
+            return
+
+        docs = set()
+        for title, info in query_titles(self.wiki, created, prop='linkshere', lhprop='title', lhlimit='max'):
+            placeholder_docs = self.mappings.docs_with_placeholder(title)
+            for link in info.get('linkshere', []):
+                doc_id = self.mappings.get_id_for_page(link['title'])
+                if doc_id in placeholder_docs:
+                    docs.add(doc_id)
+
+        logging.info(f"Relinking {len(docs)} docs that link to {len(created)} new docs")
+        # No files folder here, so only fix links to docs
+        linker = GDocLinks(self.wiki, self, self.file_prefix, None)
+        self.check_docs(linker, docs)
+
+
+    def folder_for(self, full_title, categories):
+        """
+        Pick the folder a new doc goes in, from its namespace or from its
+        `categories` (full "Category:" titles). Defaults to the unsorted
+        folder.
+        """
+        if ":" in full_title:
+            namespace = full_title.split(":", 1)[0]
+            if namespace in self.namespace_to_folder:
+                return self.common_folders[namespace]
+            return self.unsorted_folder_id
+
+        # Note that we just pick the first possible mapping, so order in category_to_folder is important
+        page_categories = [c.replace('Category:', '') for c in categories]
+        for c in self.category_to_folder.keys():
+            if c in page_categories:
+                return self.common_folders[c]
+        return self.unsorted_folder_id
+
 
-        self.mappings.save()
+    def reserve_docs(self):
+        """
+        First phase of a two-phase export: create an empty doc, straight
+        in the right folder, for every wiki page that doesn't have one.
+        Categories come from batched `prop=categories` queries and the docs
+        get created in Drive batch requests.
+        """
+        titles = [page.name for page in self.wiki.pages
+                if not self.mappings.has_page(page.name)]
+        if not titles:
+            return
+
+        categories = {}
+        for title, info in query_titles(self.wiki, titles, prop='categories', cllimit='max'):
+            categories[title] = [c['title'] for c in info.get('categories', [])]
+
+        creates = []
+        for full_title in titles:
+            name = full_title.split(":", 1)[1] if ":" in full_title else full_title
+            folder_id = self.folder_for(full_title, categories.get(full_title, []))
+            creates.append(self.drive.files().create(
+                body={
+                    'name': name,
+                    'mimeType': DOCUMENT_MIME_TYPE,
+                    'parents': [folder_id],
+                },
+                supportsAllDrives=True,
+                fields='id'))
+
+        reserved = 0
+        for full_title, result in zip(titles, self.execute_batch(creates)):
+            if isinstance(result, HttpError):
+                logging.warning(f"Could not reserve a doc for {full_title}: {result}")
+                continue
+            self.mappings.add_reserved(full_title, result['id'])
+            reserved += 1
+            with self.pending_lock:
+                self.created_titles.append(full_title)
+        logging.info(f"Reserved {reserved} of {len(titles)} new docs")
+
+
+    def run_check_links(self, wiki, file_prefix, files_folder_id, folder_id, force=False):
+        """
+        Repair links in docs under `folder_id`, see `check_docs`.
 
+        Only checks docs that changed since their last check, going by the
+        drive mirror's modifiedTime, or that hold placeholders for titles
+        that have a doc now. `force` checks everything.
+        """
+        self.load_title_resolver(wiki)
+        folder_docs = self.recursive_docs_in_folder(folder_id)
+        modified_times = self.mirror.modified_times()
+        if force:
+            docs = folder_docs
+        else:
+            checked = self.mappings.get_link_checks()
+            resolvable = self.mappings.docs_with_resolvable_placeholders()
+            docs = [doc_id for doc_id in folder_docs
+                    if doc_id in resolvable
+                    or checked.get(doc_id) is None
+                    or checked[doc_id] != modified_times.get(doc_id)]
+            logging.info(f"Checking links in {len(docs)} of {len(folder_docs)} docs")
+        linker = GDocLinks(wiki, self, file_prefix, files_folder_id)
+        self.check_docs(linker, docs, modified_times)
+
+
+    def check_docs(self, linker, docs, modified_times=None):
+        """
+        Run `linker` over `docs` on a pool of `self.workers` threads. They
+        share the one linker, so they also share the mappings and rate
+        limiters. A doc that fails is logged and skipped.
+        """
+        modified_times = modified_times or {}
+        def check_isolated(doc_id):
+            try:
+                linker.check_links(doc_id, modified_times.get(doc_id))
+                return True
+            except Exception as e:
+                logging.exception(f"Failed to check links in {doc_id}, skipping: {e}")
+                return False
 
-    def run_check_links(self, wiki, file_prefix, files_folder_id, folder_id):
-        docs = self.recursive_docs_in_folder(folder_id)
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(check_isolated, doc_id): doc_id for doc_id in docs}
+                try:
+                    for future in as_completed(futures):
+                        if not future.result():
+                            failed.append(futures[future])
+                except BaseException:
+                    # Same as `convert_pages`: don't check the queued docs
+                    # once we've been interrupted
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise
+        finally:
+            # Send the tags these docs queued even if we got interrupted
+            self.flush_metadata()
 
-        for doc_id in docs.keys():
-            linker = GDocLinks(wiki, self, file_prefix, files_folder_id)
-            linker.check_links(doc_id)
+        logging.info(f"Checked links in {len(docs) - len(failed)} docs")
+        if failed:
+            logging.warning(f"{len(failed)} docs failed link checks: {', '.join(sorted(failed))}")
 
 
     def recursive_docs_in_folder(self, folder_id):
@@ -98,89 +293,60 @@ class GDocDriver:
 
     def get_relevant_files(self, relevant_folders):
         """
-        Get files under the relevant_folders and all their subfolders.
+        Get files directly under the relevant_folders, as a dictionary of
+        file IDs mapped to file names, from the local drive mirror.
         """
-        relevant_files = {}
-        chunked_relevant_folders = \
-            [relevant_folders[i:i + MAX_PARENTS] \
-                for i in range(0, len(relevant_folders), MAX_PARENTS)]
-        for folder_list in chunked_relevant_folders:
-            query_term = ' in parents or '.join('"{0}"'.format(f) for f in folder_list) + ' in parents'
-            relevant_files.update(self.get_all_files_in_folders(query_term))
-        return relevant_files
-
-
-    def get_all_files_in_folders(self, parent_folders):
-        """
-        Return a dictionary of file IDs mapped to file names for the specified parent folders.
-        """
-        files_under_folder = {}
-        page_token = None
-        max_allowed_page_size = 1000
-        just_files = f"mimeType != 'application/vnd.google-apps.folder' and trashed = false and ({parent_folders})"
-        while True:
-            results = self.drive.files().list(
-                pageSize=max_allowed_page_size,
-                fields="nextPageToken, files(id, name, mimeType, parents)",
-                includeItemsFromAllDrives=True, supportsAllDrives=True,
-                corpora='drive',
-                driveId=self.drive_id,
-                pageToken=page_token,
-                q=just_files).execute()
-            files = results.get('files', [])
-            page_token = results.get('nextPageToken', None)
-            for file in files:
-                files_under_folder[file['id']] = file['name']
-            if page_token is None:
-                break
-        return files_under_folder
+        return self.mirror.files_in_folders(relevant_folders)
 
 
     def all_folders_in_drive(self):
         """
         Return a dictionary of all the folder IDs in a drive mapped to their 
         parent folder IDs (or to the drive itself if a top-level folder).
-        This flattens the entire folder structure.
+        This flattens the entire folder structure. Folder names end up in
+        `self.folder_names`.
 
-        Note that this caches the result, because for our purposes the
-        folders will not be changing often enough to matter.
+        This comes from the local drive mirror, which gets brought up to
+        date from the changes feed the first time it's used in a run.
         """
         if len(self.folders) > 0:
             return self.folders
 
-        page_token = None
-        max_allowed_page_size = 1000
-        just_folders = "trashed = false and mimeType = 'application/vnd.google-apps.folder'"
-        while True:
-            results = self.drive.files().list(
-                pageSize=max_allowed_page_size,
-                fields="nextPageToken, files(id, name, mimeType, parents)",
-                includeItemsFromAllDrives=True, supportsAllDrives=True,
-                corpora='drive',
-                driveId=self.drive_id,
-                pageToken=page_token,
-                q=just_folders).execute()
-            result_folders = results.get('files', [])
-            page_token = results.get('nextPageToken', None)
-            for folder in result_folders:
-                self.folders[folder['id']] = folder['parents'][0]
-            if page_token is None:
-                break
-
+        self.folders, self.folder_names = self.mirror.folders()
         return self.folders
 
 
+    def folder_tree(self):
+        """
+        The drive's folder tree index, with folder names. Built once per
+        run from the local drive mirror, after it's caught up with the
+        changes feed, so new folders are always in it.
+        """
+        if self.tree is None:
+            self.tree = FolderTree(self.drive_id, self.all_folders_in_drive(), self.folder_names)
+        return self.tree
+
+
+    def load_title_resolver(self, wiki):
+        """
+        Give the mappings a `TitleResolver` so links through redirects or
+        with odd capitalization find their docs. The redirect map is saved
+        to `REDIRECTS_FILE` and refetched in bulk after
+        `REDIRECT_CACHE_TTL` seconds.
+        """
+        resolver = TitleResolver.load(REDIRECTS_FILE)
+        if resolver is None or not resolver.is_fresh(REDIRECT_CACHE_TTL):
+            resolver = TitleResolver.fetch(wiki)
+            resolver.save(REDIRECTS_FILE)
+        self.mappings.resolver = resolver
+
+
     def folders_in_folder(self, folder_to_search):
         """
         Yield subfolders of the folder-to-search, and then subsubfolders etc.
         Must be called by an iterator.
         """
-        # Get all subfolders
-        temp_list = [k for k, v in self.all_folders_in_drive().items() if v == folder_to_search]
-        for sub_folder in temp_list:
-            yield sub_folder
-            # Recurse
-            yield from self.folders_in_folder(sub_folder)
+        yield from self.folder_tree().descendants(folder_to_search)
 
 
     def load_common_folders(self):
@@ -208,30 +374,63 @@ class GDocDriver:
             'User': 'People',
         }
 
-        self.folders = {}
+        # Folder IDs for each category and namespace
+        self.common_folders = {}
         for category, name in self.category_to_folder.items():
-            self.folders[category] = self.find_folder(name)
+            self.common_folders[category] = self.find_folder(name)
 
         for namespace, name in self.namespace_to_folder.items():
-            self.folders[namespace] = self.find_folder(name)
+            self.common_folders[namespace] = self.find_folder(name)
 
 
     def convert_one(self, title):
+        # Asking for one page by name means you want it written
         page = self.wiki.pages[title]
-        self.convert(page)
+        self.convert(page, skip_unchanged=False)
 
     def convert_category(self, category_name):
         category = self.wiki.categories[category_name]
-        for page in category:
-            self.convert(page)
+        self.convert_pages(category)
 
-    def convert_all(self, only_if_new=False, older_than=None):
-        for page in self.wiki.pages:
-            did_stuff = self.convert(page, only_if_new=only_if_new, older_than=older_than)
+    def convert_all(self, only_if_new=False, only_if_stale=False):
+        self.convert_pages(self.wiki.pages, only_if_new=only_if_new, only_if_stale=only_if_stale)
+
+    def convert_pages(self, pages, **kwargs):
+        """
+        Convert pages on a pool of `self.workers` threads. A page that fails
+        is logged and skipped, it doesn't stop the rest of the run.
+        """
+        def convert_isolated(page):
+            try:
+                return self.convert(page, **kwargs)
+            except Exception as e:
+                logging.exception(f"Failed to convert {page.name}, skipping: {e}")
+                return None
+
+        converted = 0
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = {executor.submit(convert_isolated, page): page.name for page in pages}
+                try:
+                    for future in as_completed(futures):
+                        result = future.result()
+                        if result is None:
+                            failed.append(futures[future])
+                        elif result:
+                            converted += 1
+                except BaseException:
+                    # Ctrl-C and the like: drop the pages still queued and
+                    # wait for the ones in flight, instead of converting them all
+                    executor.shutdown(wait=True, cancel_futures=True)
+                    raise
+        finally:
+            # Move the new docs into their folders even if we got interrupted
+            self.flush_metadata()
 
-            if did_stuff:
-                # Hitting some Google api limits, so let's sleep a bit here
-                time.sleep(10.0)
+        logging.info(f"Converted {converted} pages")
+        if failed:
+            logging.warning(f"{len(failed)} pages failed to convert: {', '.join(sorted(failed))}")
 
     def convert_all_new(self):
         self.convert_all(only_if_new=True)
@@ -259,154 +458,392 @@ class GDocDriver:
             with open(token_file, 'w') as token:
                 token.write(creds.to_json())
 
-        self.docs = build('docs', 'v1', credentials=creds)
-        self.drive = build('drive', 'v3', credentials=creds)
+        self.creds = creds
 
 
-    def find_folder(self, name):
+    @property
+    def docs(self):
+        """
+        The Docs service for the current thread, because the underlying
+        httplib2 connections aren't safe to share between threads.
+        """
+        if not hasattr(self.local, 'docs'):
+            self.local.docs = build('docs', 'v1', credentials=self.creds)
+        return self.local.docs
+
+    @property
+    def drive(self):
+        """
+        The Drive service for the current thread, see `docs`.
+        """
+        if not hasattr(self.local, 'drive'):
+            self.local.drive = build('drive', 'v3', credentials=self.creds)
+        return self.local.drive
+
+
+    def execute(self, request):
         """
-        Find folder across all drives by name.
+        Run a Docs or Drive API request under that service's shared rate
+        limiter, backing off and retrying if we hit a quota.
+        """
+        if 'docs.googleapis.com' in request.uri:
+            limiter = self.docs_limiter
+        else:
+            limiter = self.drive_limiter
+
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                result = request.execute()
+            except HttpError as e:
+                if not is_rate_limited(e) or attempt >= MAX_RETRIES:
+                    raise
+                attempt += 1
+                limiter.rate_limited(retry_after(e))
+                continue
+            limiter.succeeded()
+            return result
 
-        NOTE: Not super reliable if folder names are not unique.
 
-        In the future it might be good to take an optional folder id,
-        and query the document's folder chain to see if it is inside that
-        folder id somewhere.
+    def find_folder(self, name):
+        """
+        Find folder in the drive by name, from the folder tree.
+        `name` can include parent folders like "Parent/Name" to tell
+        apart folders with the same name, see `FolderTree.find`.
         """
 
-        result = self.drive.files().list(q = f"mimeType = 'application/vnd.google-apps.folder' and name = '{name}'",
-                driveId=self.drive_id, corpora="drive",
-                includeItemsFromAllDrives=True,
-                supportsAllDrives=True,
-                pageSize=10, fields="nextPageToken, files(id, name)").execute()
-        folder_id_result = result.get('files', [])
-        # If this fails, we couldn't find a folder named `name`
-        actual_id = folder_id_result[0].get('id')
+        actual_id = self.folder_tree().find(name)
+        if actual_id is None:
+            raise ValueError(f"Could not find folder named {name} in drive {self.drive_id}")
         logging.info(f"Found folder named {name} with {actual_id}")
         return actual_id
 
 
+    def execute_batch(self, requests):
+        """
+        Run Drive requests through BatchHttpRequests of up to
+        `MAX_BATCH` requests each, under the Drive rate limiter.
+
+        Returns a list in the same order as `requests` holding either the
+        response or the HttpError for that request. Requests that were rate
+        limited get retried in a later batch.
+        """
+        results = [None] * len(requests)
+        pending = list(range(len(requests)))
+        attempt = 0
+        while pending:
+            limited = []
+            wait = None
+            for start in range(0, len(pending), MAX_BATCH):
+                chunk = pending[start:start + MAX_BATCH]
+
+                def callback(request_id, response, exception):
+                    nonlocal wait
+                    i = int(request_id)
+                    if exception is not None and is_rate_limited(exception) and attempt < MAX_RETRIES:
+                        limited.append(i)
+                        wait = retry_after(exception) or wait
+                    else:
+                        results[i] = exception if exception is not None else response
+
+                batch = self.drive.new_batch_http_request(callback=callback)
+                for i in chunk:
+                    batch.add(requests[i], request_id=str(i))
+                self.drive_limiter.acquire(len(chunk))
+                batch.execute()
+
+            if limited:
+                attempt += 1
+                self.drive_limiter.rate_limited(wait)
+            else:
+                self.drive_limiter.succeeded()
+            pending = sorted(limited)
+        return results
+
+
     def reparent(self, doc_id, folder_id):
         """
-        Reparent document to a specific folder using the drive API.
+        Queue moving a document into a specific folder. Moves are sent in
+        batches, see `flush_reparents`.
         """
+        with self.pending_lock:
+            self.pending_reparents[doc_id] = folder_id
+            full = len(self.pending_reparents) >= MAX_BATCH
+        if full:
+            self.flush_reparents()
 
-        f = self.drive.files().get(fileId=doc_id,
+
+    def flush_reparents(self):
+        """
+        Do all queued moves: one batch to read current parents, and one
+        batch to update the documents that aren't already in place.
+        """
+        with self.pending_lock:
+            moves = self.pending_reparents
+            self.pending_reparents = {}
+        if not moves:
+            return
+
+        doc_ids = list(moves.keys())
+        current = self.execute_batch([self.drive.files().get(fileId=doc_id,
                 fields='parents',
-                supportsAllDrives=True).execute()
-        previous_parents = ",".join(f.get('parents'))
-        if not folder_id in previous_parents:
-            result = self.drive.files().update(
-                fileId=doc_id,
-                addParents=folder_id,
-                removeParents=previous_parents,
-                fields='id, parents',
-                supportsAllDrives=True,
-            ).execute()
+                supportsAllDrives=True) for doc_id in doc_ids])
+
+        updates = []
+        for doc_id, f in zip(doc_ids, current):
+            if isinstance(f, HttpError):
+                logging.warning(f"Could not read parents of {doc_id} to move it: {f}")
+                continue
+            folder_id = moves[doc_id]
+            previous_parents = ",".join(f.get('parents', []))
+            if not folder_id in previous_parents:
+                updates.append(self.drive.files().update(
+                    fileId=doc_id,
+                    addParents=folder_id,
+                    removeParents=previous_parents,
+                    fields='id, parents',
+                    supportsAllDrives=True,
+                ))
+
+        for result in self.execute_batch(updates):
+            if isinstance(result, HttpError):
+                logging.warning(f"Could not move document: {result}")
 
 
     def add_tag(self, doc_id, tag):
         """
-        Store tag in document properties if it's not already there
+        Queue a tag to be stored in document properties if it's not already
+        there. Tags are collected per document and written in batches, see
+        `flush_tags`.
         """
 
         if " " in tag:
             raise ValueError(f"Google drive properties can't have spaces, can't add tag '{tag}'")
-        result = self.drive.files().get(fileId=doc_id,
+
+        with self.pending_lock:
+            self.pending_tags.setdefault(doc_id, set()).add(tag)
+            full = len(self.pending_tags) >= MAX_BATCH
+        if full:
+            self.flush_tags()
+
+
+    def flush_tags(self):
+        """
+        Write all queued tags: one batch to read current properties, and one
+        batch with a single update per document that is missing any.
+        """
+        with self.pending_lock:
+            tags = self.pending_tags
+            self.pending_tags = {}
+        if not tags:
+            return
+
+        doc_ids = list(tags.keys())
+        current = self.execute_batch([self.drive.files().get(fileId=doc_id,
                 fields='properties',
-                supportsAllDrives=True).execute()
+                supportsAllDrives=True) for doc_id in doc_ids])
 
-        if 'properties' in result:
-            props = result['properties']
-        else:
-            props = {}
+        updates = []
+        for doc_id, result in zip(doc_ids, current):
+            if isinstance(result, HttpError):
+                logging.warning(f"Could not read properties of {doc_id} to tag it: {result}")
+                continue
+            props = result.get('properties', {})
 
-        tag_with_prefix = f"tags/{tag}"
-        if not tag_with_prefix in props:
-            logging.info(f"Adding tag {tag} to {doc_id}")
             # Yes, the weird way gdocwiki stores these as is a prefixed key 
-            # and a blank value
-            props[tag_with_prefix] = ''
-            self.drive.files().update(
-                fileId=doc_id,
-                fields='id, properties',
-                body={'properties': props},
-                supportsAllDrives=True,
-            ).execute()
+            # and a blank value. Properties updates merge, so we only send
+            # the new ones.
+            new_props = {f"tags/{tag}": '' for tag in tags[doc_id]
+                    if not f"tags/{tag}" in props}
+            if new_props:
+                logging.info(f"Adding tags {', '.join(sorted(new_props))} to {doc_id}")
+                updates.append(self.drive.files().update(
+                    fileId=doc_id,
+                    fields='id, properties',
+                    body={'properties': new_props},
+                    supportsAllDrives=True,
+                ))
+
+        for result in self.execute_batch(updates):
+            if isinstance(result, HttpError):
+                logging.warning(f"Could not tag document: {result}")
+
+
+    def flush_metadata(self):
+        """
+        Send any queued folder moves and tags.
+        """
+        self.flush_reparents()
+        self.flush_tags()
 
 
     def get_document(self, doc_id):
-        return self.docs.documents().get(documentId=doc_id).execute()
+        """
+        Get a doc's full JSON. Asks for just its revisionId first, and if
+        we have a snapshot at that revision, uses that instead of
+        downloading the whole doc again.
+        """
+        revision = self.execute(self.docs.documents().get(documentId=doc_id,
+                fields='revisionId'))['revisionId']
+        document = self.snapshots.get(doc_id, revision)
+        if document is not None:
+            return document
+        document = self.execute(self.docs.documents().get(documentId=doc_id))
+        self.snapshots.put(document)
+        return document
+
+    def get_document_end(self, doc_id):
+        """
+        Return the end index of a doc's body and its revision ID, without
+        downloading the rest of the doc.
+        """
+        document = self.execute(self.docs.documents().get(documentId=doc_id,
+                fields='revisionId,body/content/endIndex'))
+        return document['body']['content'][-1]['endIndex'], document['revisionId']
 
-    def get_document_modified_date(self, doc_id):
-        f = self.drive.files().get(fileId=doc_id,
+    def fetch_modified_time(self, doc_id):
+        """
+        Ask Drive for a doc's current modifiedTime, as the raw string.
+        """
+        f = self.execute(self.drive.files().get(fileId=doc_id,
                 fields='modifiedTime',
-                supportsAllDrives=True).execute()
-        return parser.parse(f['modifiedTime'])
+                supportsAllDrives=True))
+        return f['modifiedTime']
 
+    def get_document_modified_date(self, doc_id):
+        if doc_id in self.modified_dates:
+            return self.modified_dates[doc_id]
+        return parser.parse(self.fetch_modified_time(doc_id))
 
-    def batch_update(self, doc_id, requests, debug=False):
+    def list_modified_dates(self):
+        """
+        Load modified dates for every Google Doc in the drive from the
+        local drive mirror, so `get_document_modified_date` doesn't need a
+        request per document.
+        """
+        for doc_id, modified_time in self.mirror.modified_times().items():
+            self.modified_dates[doc_id] = parser.parse(modified_time)
+        return self.modified_dates
+
+
+    def plan_stale_titles(self, older_than):
+        """
+        Work out which mapped pages need converting again: their doc was
+        last modified before `older_than`, and the wiki page has been
+        edited since the doc was last modified.
+
+        Uses the local drive mirror for all the doc dates and batched
+        `prop=revisions` queries for the wiki dates. Both are UTC. We go by
+        the latest revision rather than `touched`, which also moves on
+        purges and template edits that don't change the page itself.
+        """
+        self.list_modified_dates()
+        # Parse the command line param and hack in a timezone
+        older_date = parser.parse(older_than).replace(tzinfo=pytz.timezone('US/Central'))
+
+        candidates = {}
+        for title, doc_id in self.mappings.items():
+            doc_date = self.modified_dates.get(doc_id)
+            if doc_date is None:
+                logging.warning(f"Mapped doc {doc_id} for {title} not found in drive listing")
+            elif doc_date < older_date:
+                candidates[title] = doc_date
+
+        stale = set()
+        # With many titles, `prop=revisions` only gives each page's latest
+        for title, info in query_titles(self.wiki, candidates.keys(), prop='revisions', rvprop='timestamp|ids'):
+            if 'missing' in info or not info.get('revisions'):
+                continue
+            wiki_date = parser.parse(info['revisions'][-1]['timestamp'])
+            if wiki_date > candidates[title]:
+                stale.add(self.mappings.normalize(title))
+
+        logging.info(f"{len(stale)} of {len(candidates)} docs older than {older_than} have newer wiki pages")
+        return stale
+
+
+    def batch_update(self, doc_id, requests, debug=False, revision_id=None):
         """
         Batch update the document with the given requests.
 
         If debug is passed, do each request one at a time, slow-ish.
+
+        If `revision_id` is passed, the update fails unless the doc is
+        still at that revision. Debug mode ignores it, since each request
+        makes a new revision.
+
+        Drops the doc's snapshot, since it's out of date now. Callers that
+        know what changed can save a patched one.
         """
-        
+        self.snapshots.discard(doc_id)
+
         if debug:
             for r in requests:
                 try:
-                    self.docs.documents().batchUpdate(
-                        documentId=doc_id, body={'requests': [r]}).execute()
+                    self.execute(self.docs.documents().batchUpdate(
+                        documentId=doc_id, body={'requests': [r]}))
                 except BaseException as e:
                     print(f"Unexpected {e}, {type(e)} with request {r}")
                     raise
                 time.sleep(0.1)
 
         else:
-            return self.docs.documents().batchUpdate(
-                documentId=doc_id, body={'requests': requests}).execute()
+            body = {'requests': requests}
+            if revision_id is not None:
+                body['writeControl'] = {'requiredRevisionId': revision_id}
+            return self.execute(self.docs.documents().batchUpdate(
+                documentId=doc_id, body=body))
 
 
-    def traverse(self, f, d, start_index, end_index):
+    def update_chunk(self, doc_id, requests, revision_id):
         """
-        Recursive method to do a common thing we'll be needing a lot:
-        store current start_index and end_index, while traversing
-        the document tree and calling a function `f` on each dict.
+        Send one chunk of a chunked update, pinned to `revision_id`, and
+        return the revision it left the doc at. Server errors get retried
+        with backoff. That's safe even if a failed attempt actually went
+        through, since the retry would then fail on the revision instead
+        of applying twice.
         """
-        if 'startIndex' in d:
-            start_index = d['startIndex']
+        attempt = 0
+        while True:
+            try:
+                result = self.batch_update(doc_id, requests, revision_id=revision_id)
+            except HttpError as e:
+                if not is_transient(e) or attempt >= MAX_RETRIES:
+                    raise
+                attempt += 1
+                logging.warning(f"Retrying chunk for doc {doc_id} after {e}")
+                time.sleep(2 ** attempt)
+                continue
+            return result['writeControl']['requiredRevisionId']
 
-        if 'endIndex' in d:
-            end_index = d['endIndex']
 
-        f(d, start_index, end_index)
+    def convert(self, page, only_if_new=False, only_if_stale=False, skip_unchanged=True, debug=False):
+        """
+        Convert `page` into its doc, creating the doc if needed.
 
-        for key, value in d.items():
-            if isinstance(value, dict):
-                self.traverse(f, value, start_index, end_index)
-            elif isinstance(value, list):
-                for item in value:
-                    if isinstance(item, dict):
-                        self.traverse(f, item, start_index, end_index)
+        `only_if_new` skips mapped pages, apart from ones whose docs were
+        reserved by `reserve_docs` and never exported into.
 
+        `only_if_stale` skips mapped pages that aren't in the
+        `stale_titles` worked out by `plan_stale_titles`.
 
-    def convert(self, page, only_if_new=False, older_than=None, debug=False):
-        if page.name in self.mappings.title_to_id:
-            if only_if_new:
+        `skip_unchanged` skips docs last exported from the page's current
+        revision by the current converter version, or whose requests come
+        out the same as last time.
+        """
+        doc_id = self.mappings.get_id_for_page(page.name)
+        if doc_id is not None:
+            # Reserved docs are still empty, so they count as new and stale,
+            # even if they were reserved by an earlier run that got cut off
+            reserved = self.mappings.is_reserved(doc_id)
+            if only_if_new and not reserved:
+                return False
+            if only_if_stale and not reserved and not page.name in self.stale_titles:
+                return False
+            if skip_unchanged and self.mappings.is_export_current(doc_id, page.revision, CONVERTER_VERSION):
+                logging.info(f"Not converting {page.name}, revision {page.revision} already exported")
                 return False
-            doc_id = self.mappings.title_to_id[page.name]
-            if older_than:
-                # someday, load up MediaWiki modify date and Google Doc modify date and compare them
-                # NOTE: I have no idea what timezone the wiki timestamps actually are 
-                # wiki_date = datetime.fromtimestamp(time.mktime(page.touched), tzinfo=pytz.timezone('US/Central'))
-                # For now, just compare doc_date with the command line
-                doc_date = self.get_document_modified_date(doc_id)
-                # Parse the command line param and hack in a timezone
-                older_date = parser.parse(older_than).replace(tzinfo=pytz.timezone('US/Central'))
-                if doc_date > older_date:
-                    return False
-
-            document = self.get_document(doc_id)
 
             logging.info(f"Converting {page.name} into existing doc {doc_id}")
         else:
@@ -421,28 +858,19 @@ class GDocDriver:
             doc_content = { 
                 'title': title,
             }
-            document = self.docs.documents().create(body=doc_content).execute()
+            document = self.execute(self.docs.documents().create(body=doc_content))
             doc_id = document['documentId']
 
             self.mappings.add(full_title, doc_id)
+            with self.pending_lock:
+                self.created_titles.append(full_title)
 
             # Now we move the file into a folder, based on category
-            # Default to the unsorted folder
-            folder_id = self.unsorted_folder_id
-
-            # But if there is a namespace or mapping to a specific folder, use it
             if namespace:
-                for n in self.namespace_to_folder.keys():
-                    if n == namespace:
-                        folder_id = self.folders[n]
-                        break
+                page_categories = []
             else:
-                # Note that we just pick the first possible mapping, so order in category_to_folder is important
-                page_categories = [c.name.replace('Category:', '') for c in page.categories()]
-                for c in self.category_to_folder.keys():
-                    if c in page_categories:
-                        folder_id = self.folders[c]
-                        break
+                page_categories = [c.name for c in page.categories()]
+            folder_id = self.folder_for(full_title, page_categories)
             self.reparent(doc_id, folder_id)
             logging.info(f"Converting {page.name} into new doc {doc_id} in folder {folder_id}")
 
@@ -454,26 +882,32 @@ class GDocDriver:
                 self.mappings,
                 self.file_prefix,
                 self.http_prefix)
-        c.convert(page, doc_id, debug=debug)
-        return True
+        return c.convert(page, doc_id, skip_unchanged=skip_unchanged, debug=debug)
 
 
-def export_mediawiki(wiki, wiki_prefix, force, older, file_prefix, http_prefix, drive_id, unsorted_folder_id, page_title=None):
-    x = GDocDriver(MAPPINGS_FILE, drive_id)
-    x.run_export(wiki, wiki_prefix, force, older, file_prefix, http_prefix, unsorted_folder_id, page_title)
+def export_mediawiki(wiki, wiki_prefix, force, older, file_prefix, http_prefix, drive_id, unsorted_folder_id, page_title=None, workers=DEFAULT_WORKERS, two_phase=False):
+    x = GDocDriver(MAPPINGS_FILE, drive_id, workers)
+    x.run_export(wiki, wiki_prefix, force, older, file_prefix, http_prefix, unsorted_folder_id, page_title, two_phase)
 
 
 
-def link_folder(wiki, file_prefix, drive_id, files_folder_id, folder_id):
-    x = GDocDriver(MAPPINGS_FILE, drive_id)
-    # Clear out link mappings because we're walkin' em all
-    x.mappings.ids_that_link_to_id = {}
-    x.run_check_links(wiki, file_prefix, files_folder_id, folder_id)
-    x.mappings.save()
+def link_folder(wiki, file_prefix, drive_id, files_folder_id, folder_id, workers=DEFAULT_WORKERS, force=False):
+    x = GDocDriver(MAPPINGS_FILE, drive_id, workers)
+    # Each doc's links get diffed against what we saw last time, so
+    # there's no need to clear the link mappings first
+    try:
+        x.run_check_links(wiki, file_prefix, files_folder_id, folder_id, force)
+    finally:
+        x.flush_metadata()
+        x.mappings.save()
 
 def link_doc(wiki, file_prefix, drive_id, files_folder_id, doc_id):
     x = GDocDriver(MAPPINGS_FILE, drive_id)
     # Check just a specific doc
+    x.load_title_resolver(wiki)
     linker = GDocLinks(wiki, x, file_prefix, files_folder_id)
-    linker.check_links(doc_id)
-    x.mappings.save()
+    try:
+        linker.check_links(doc_id)
+    finally:
+        x.flush_metadata()
+        x.mappings.save()
@@ -0,0 +1,79 @@
+import logging
+
+class FolderTree:
+    """
+    Index of a drive's folder structure with parent → children adjacency
+    lists, so finding everything under a folder doesn't rescan every folder
+    at every level.
+
+    Built from the flat folder → parent and folder → name dicts that
+    `GDocDriver.all_folders_in_drive` gets from the drive mirror. Also
+    resolves folder names without asking Drive.
+    """
+
+    def __init__(self, drive_id, parents, names):
+        self.drive_id = drive_id
+        self.parents = parents
+        self.names = names
+        self.children = {}
+        self.by_name = {}
+        for folder_id, parent_id in parents.items():
+            self.children.setdefault(parent_id, []).append(folder_id)
+        for folder_id, name in names.items():
+            self.by_name.setdefault(name, []).append(folder_id)
+
+
+    def descendants(self, folder_id):
+        """
+        Yield every folder below `folder_id`, parents before their
+        children. Walks with an explicit stack so deep trees don't hit
+        Python's recursion limit.
+        """
+        stack = list(reversed(self.children.get(folder_id, [])))
+        seen = set()
+        while stack:
+            current = stack.pop()
+            # Drive doesn't allow cycles, but don't hang if the data is odd
+            if current in seen:
+                continue
+            seen.add(current)
+            yield current
+            stack.extend(reversed(self.children.get(current, [])))
+
+
+    def ancestors(self, folder_id):
+        """
+        Yield the IDs of the folders above `folder_id`, nearest first.
+        """
+        seen = set()
+        current = self.parents.get(folder_id)
+        while current in self.parents and not current in seen:
+            seen.add(current)
+            yield current
+            current = self.parents[current]
+
+
+    def find(self, path):
+        """
+        Find a folder ID by name. If several folders share a name, `path`
+        can include some of its parents to pick one, like
+        "Lab/Behavioral Tasks". If that's still ambiguous, the folder
+        closest to the top of the drive wins.
+
+        Returns None if nothing matches.
+        """
+        parts = [p for p in path.split("/") if p]
+        if not parts:
+            return None
+        candidates = []
+        for folder_id in self.by_name.get(parts[-1], []):
+            chain = [self.names.get(a) for a in self.ancestors(folder_id)]
+            if chain[:len(parts) - 1] == list(reversed(parts[:-1])):
+                candidates.append((len(chain), folder_id))
+        if not candidates:
+            return None
+        candidates.sort()
+        if len(candidates) > 1:
+            logging.warning(f"Found {len(candidates)} folders matching '{path}', using "
+                    f"{candidates[0][1]}; add parent folders to the name to pick another")
+        return candidates[0][1]
@@ -1,12 +1,17 @@
 import logging
 import re
+import threading
 import urllib.parse
 from apiclient.http import MediaFileUpload
 from apiclient.errors import HttpError
+from gdocwalk import iter_links, patch_links
 
 GOOGLE_DOCS_PREFIX = "https://docs.google.com/document/d/"
 GOOGLE_DRIVE_PREFIX = "https://drive.google.com/file/d/"
 
+doc_id_regex = re.compile('docs.google.com/document/d/([^/]{40,})', re.IGNORECASE)
+category_regex = re.compile(r'[^a-zA-Z0-9.!@$%&*()/]', re.IGNORECASE)
+
 class GDocLinks:
     def __init__(self, wiki, driver, file_prefix, folder_id):
         """
@@ -14,18 +19,29 @@ class GDocLinks:
         can stash files, the mappings so we can save what links to what and 
         what file IDs represent what wiki files, and the folder_id in Drive to 
         store new files
+
+        With no folder_id, links to files that aren't in Drive yet are left
+        alone, and docs aren't marked as checked since they may still need
+        those files.
         """
         self.wiki = wiki
         self.driver = driver
         self.file_prefix = file_prefix
         self.mappings = driver.mappings
         self.folder_id = folder_id
+        # One linker gets shared by all the link checking threads, this
+        # stops two of them uploading the same file
+        self.upload_lock = threading.Lock()
 
 
-    def check_links(self, doc_id):
+    def check_links(self, doc_id, modified_time=None):
         """
         Updates any links with "wiki://" prefixes if they exist in the 
         driver's mappings to the resulting doc or file ID
+
+        `modified_time` is the doc's Drive modifiedTime from the listing
+        we picked it from. It gets stored with the link check so unchanged
+        docs can be skipped next time.
         """
         logging.info(f"Re-linking inside doc {doc_id}")
         try:
@@ -34,25 +50,16 @@ class GDocLinks:
             logging.warning(f"HttpError when trying to read doc {doc_id}: {e}")
             return
 
-        content = document['body']['content']
         requests = []
+        # Every doc this one links to, to update the reverse link index
+        linked_ids = set()
+        # Titles that still have no doc, so we know to come back later
+        placeholders = set()
 
-        doc_id_regex = re.compile('docs.google.com/document/d/([^/]{40,})', re.IGNORECASE)
-        category_regex = re.compile(r'[^a-zA-Z0-9.!@$%&*()/]', re.IGNORECASE)
-
-        # Now we walk the AST looking for links
         # Links are stored as 'link' properties inside the 'textStyle'
-        # properties of 'textRun' elements.
-        def check_for_link(element, start_index, end_index):
-            if not 'link' in element:
-                return False
-
-            link = element['link']
-            if 'url' in link:
-                url = link['url']
-            else:
-                return False
-
+        # properties of 'textRun' elements, `iter_links` finds them for us
+        # in the body, headers, footers and footnotes.
+        def check_for_link(segment_id, start_index, end_index, url):
             if url.startswith("wiki://"):
                 # Check in mappings for something with that title
                 _, title = url.split("://", 2)
@@ -65,42 +72,18 @@ class GDocLinks:
                     # Title is... sometimes URI encoded
                     clean_title = urllib.parse.unquote(title)
 
-                    if clean_title in self.mappings.file_to_id:
-                        file_url = GOOGLE_DRIVE_PREFIX + self.mappings.file_to_id[clean_title]
-                    else:
-                        # TODO: Merge this stuff into a central place so initial conversion can do it, too?
-                        # Bring file over, store in mappings
-                        filename = self.file_prefix + "/" + clean_title
-                        try:
-                            logging.debug(f"Downloading wiki file {clean_title} to {filename}")
-                            wiki_file = self.wiki.pages[clean_title]
-                            with open(filename, 'wb') as fd:
-                                wiki_file.download(fd)
-                        except KeyError as e:
-                            logging.warning(f"File '{title}' cleaned as '{clean_title}' not found in wiki when checking links in {doc_id}")
-                            return False
-
-                        file_metadata = {
-                            'name': clean_title.replace("File:", ""),
-                            'mimeType': '*/*',
-                            'parents': [self.folder_id],
-                        }
-                        media = MediaFileUpload(filename,
-                            mimetype='*/*',
-                            resumable=True)
-
-                        result = self.driver.drive.files().create(
-                                body=file_metadata,
-                                media_body=media,
-                                supportsAllDrives=True,
-                                fields='id').execute()
-                        file_id = result.get('id')
-
-                        self.mappings.file_to_id[clean_title] = file_id
-                        file_url = GOOGLE_DRIVE_PREFIX + file_id
+                    file_id = self.mappings.get_file_id(clean_title)
+                    if file_id is None and self.folder_id is None:
+                        return False
+                    if file_id is None:
+                        file_id = self.upload_file(clean_title)
+                    if file_id is None:
+                        logging.warning(f"File '{title}' cleaned as '{clean_title}' not found in wiki when checking links in {doc_id}")
+                        return False
+                    file_url = GOOGLE_DRIVE_PREFIX + file_id
 
                     logging.info(f"Linking {title}, cleaned as {clean_title}, to {file_url}")
-                    request = self.fix_link(start_index, end_index, file_url)
+                    request = self.fix_link(segment_id, start_index, end_index, file_url)
                     requests.append(request)
 
                 elif "Category:" in title:
@@ -109,34 +92,114 @@ class GDocLinks:
                     category = category_regex.sub("-", category)
                     self.driver.add_tag(doc_id, category)
 
-                elif title in self.mappings.title_to_id:
-                    doc_url = GOOGLE_DOCS_PREFIX + self.mappings.title_to_id[title]
-                    request = self.fix_link(start_index, end_index, doc_url)
+                elif self.mappings.has_title(title):
+                    link_doc_id = self.mappings.get_id_for_title(title)
+                    linked_ids.add(link_doc_id)
+                    doc_url = GOOGLE_DOCS_PREFIX + link_doc_id
+                    request = self.fix_link(segment_id, start_index, end_index, doc_url)
                     requests.append(request)
 
+                else:
+                    placeholders.add(title)
+
             else:
                 match = doc_id_regex.search(url)
                 if match:
                     # Track this link in our mappings
                     link_doc_id = match.group(1)
-                    if not link_doc_id in self.mappings.ids_that_link_to_id:
-                        self.mappings.ids_that_link_to_id[link_doc_id] = []
+                    linked_ids.add(link_doc_id)
 
-                    if not doc_id in self.mappings.ids_that_link_to_id[link_doc_id]:
-                        self.mappings.ids_that_link_to_id[link_doc_id].append(doc_id)
-
-        for item in content:
-            self.driver.traverse(check_for_link, item, 0, 0)
+        for segment_id, start_index, end_index, url in iter_links(document):
+            check_for_link(segment_id, start_index, end_index, url)
 
         # Because indexes and content aren't changing through these edits,
         # we can send them as a batch in any order, hooray
         if requests:
             logging.info(f"Found {len(requests)} links in need of updating, sending batch")
-            self.driver.batch_update(doc_id, requests)
-            self.mappings.save()
+            # Pinned to the revision we read, so the patched snapshot can't
+            # miss someone else's edit
+            result = self.driver.batch_update(doc_id, requests, revision_id=document['revisionId'])
+            # Our own edit bumps modifiedTime, don't count it as a change
+            modified_time = None
+            self.save_patched_snapshot(document, requests, result)
+        self.mappings.set_links(doc_id, linked_ids)
+        self.mappings.set_placeholders(doc_id, placeholders)
+        if self.folder_id is not None:
+            if modified_time is None:
+                modified_time = self.driver.fetch_modified_time(doc_id)
+            self.mappings.record_link_check(doc_id, modified_time)
+        self.mappings.save()
+
+
+    def upload_file(self, clean_title):
+        """
+        Bring a wiki file over into the files folder and store it in
+        mappings. Returns the new file ID, or None if the wiki doesn't have
+        the file.
+        """
+        with self.upload_lock:
+            # Another thread may have uploaded it while we waited
+            file_id = self.mappings.get_file_id(clean_title)
+            if file_id is not None:
+                return file_id
+
+            # TODO: Merge this stuff into a central place so initial conversion can do it, too?
+            filename = self.file_prefix + "/" + clean_title
+            try:
+                logging.debug(f"Downloading wiki file {clean_title} to {filename}")
+                wiki_file = self.wiki.pages[clean_title]
+                with open(filename, 'wb') as fd:
+                    wiki_file.download(fd)
+            except KeyError as e:
+                return None
+
+            file_metadata = {
+                'name': clean_title.replace("File:", ""),
+                'mimeType': '*/*',
+                'parents': [self.folder_id],
+            }
+            media = MediaFileUpload(filename,
+                mimetype='*/*',
+                resumable=True)
+
+            result = self.driver.execute(self.driver.drive.files().create(
+                    body=file_metadata,
+                    media_body=media,
+                    supportsAllDrives=True,
+                    fields='id'))
+            file_id = result.get('id')
 
+            self.mappings.add_file(clean_title, file_id)
+            return file_id
 
-    def fix_link(self, start_index, end_index, url):
+
+    def save_patched_snapshot(self, document, requests, result):
+        """
+        Link fixes don't move any text, so we can apply them to the copy of
+        the doc we read and save that as the snapshot for the revision our
+        update made, instead of downloading the doc again next time.
+        """
+        revision_id = result.get('writeControl', {}).get('requiredRevisionId')
+        if revision_id is None:
+            return
+        links = {}
+        for r in requests:
+            update = r['updateTextStyle']
+            text_range = update['range']
+            key = (text_range.get('segmentId'), text_range['startIndex'], text_range['endIndex'])
+            links[key] = update['textStyle']['link']['url']
+        patch_links(document, links)
+        self.driver.snapshots.put(document, revision_id)
+
+
+    def fix_link(self, segment_id, start_index, end_index, url):
+        text_range = {
+            "startIndex": start_index,
+            "endIndex": end_index
+        }
+        # Headers, footers and footnotes need their segment named
+        if segment_id is not None:
+            text_range["segmentId"] = segment_id
         return {
             "updateTextStyle": {
                 "textStyle": {
@@ -144,10 +207,7 @@ class GDocLinks:
                         "url": url
                     }
                 },
-                "range": {
-                    "startIndex": start_index,
-                    "endIndex": end_index
-                },
+                "range": text_range,
                 "fields": "link"
             }
         }
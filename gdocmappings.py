@@ -1,51 +1,383 @@
 import os
 import json
+import sqlite3
+import threading
+import time
+import logging
+
+from wikititles import normalize_title
+
+# Exports and links get committed in batches of this many writes, or after
+# this many seconds, whichever comes first
+COMMIT_EVERY = 100
+COMMIT_INTERVAL = 5.0
+
+# How long to wait on another process holding the database lock
+LOCK_TIMEOUT = 60.0
 
 class GDocMappings:
-    def __init__(self, path):
+    """
+    Stores which wiki titles and files live in which Google Docs and Drive
+    files, which docs link to which, and what we last exported.
+
+    Backed by SQLite, so lookups are indexed, writes are small, and several
+    processes can share the file (SQLite locks it for us). Everything is
+    also kept in memory for fast lookups by the export workers in this
+    process, which share one object.
+
+    Writes that record something we just created in Drive (`add`,
+    `add_file`) are committed right away so a crash can't orphan it.
+    Everything else is committed in batches, and on `save`.
+    """
+
+    def __init__(self, path, legacy_json_path=None):
         self.path = path
-        if os.path.exists(path):
-            with open(path) as json_file:
-                data = json.load(json_file)
-                self.title_to_id = data['title_to_id']
-                self.id_to_title = data['id_to_title']
-                self.ids_that_link_to_id = data['ids_that_link_to_id']
-                self.do_not_convert = data['do_not_convert']
-                self.file_to_id = data['file_to_id']
-
-        else:
+        # A `TitleResolver` for redirects and namespaces, if we have a wiki
+        self.resolver = None
+        # Export workers share one mappings object, so anything that touches
+        # the database or writes to the dicts takes this lock
+        self.lock = threading.RLock()
+        self.pending_writes = 0
+        self.last_commit = time.monotonic()
+
+        self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS titles (
+                title TEXT PRIMARY KEY,
+                doc_id TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS titles_doc_id ON titles (doc_id);
+            CREATE TABLE IF NOT EXISTS files (
+                title TEXT PRIMARY KEY,
+                file_id TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS links (
+                target_id TEXT NOT NULL,
+                source_id TEXT NOT NULL,
+                PRIMARY KEY (target_id, source_id)
+            );
+            CREATE INDEX IF NOT EXISTS links_source_id ON links (source_id);
+            CREATE TABLE IF NOT EXISTS do_not_convert (
+                title TEXT PRIMARY KEY
+            );
+            CREATE TABLE IF NOT EXISTS exported (
+                doc_id TEXT PRIMARY KEY,
+                revid INTEGER,
+                hash TEXT,
+                version INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS link_checks (
+                doc_id TEXT PRIMARY KEY,
+                modified_time TEXT
+            );
+            CREATE TABLE IF NOT EXISTS placeholders (
+                doc_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                PRIMARY KEY (doc_id, title)
+            );
+            CREATE INDEX IF NOT EXISTS placeholders_title ON placeholders (title);
+            CREATE TABLE IF NOT EXISTS export_progress (
+                doc_id TEXT PRIMARY KEY,
+                hash TEXT,
+                chunks_done INTEGER,
+                revision_id TEXT
+            );
+            CREATE TABLE IF NOT EXISTS reserved (
+                doc_id TEXT PRIMARY KEY
+            );
+        """)
+
+        if legacy_json_path and os.path.exists(legacy_json_path) and self.is_empty():
+            self.import_json(legacy_json_path)
+
+        self.load()
+
+
+    def is_empty(self):
+        return self.db.execute("SELECT COUNT(*) FROM titles").fetchone()[0] == 0
+
+
+    def import_json(self, json_path):
+        """
+        One-time import from the old `mappings.google.json` format.
+        """
+        logging.warning(f"Importing mappings from {json_path} into {self.path}")
+        with open(json_path) as json_file:
+            data = json.load(json_file)
+        with self.db:
+            self.db.executemany("INSERT OR REPLACE INTO titles VALUES (?, ?)",
+                    data['title_to_id'].items())
+            self.db.executemany("INSERT OR REPLACE INTO files VALUES (?, ?)",
+                    data['file_to_id'].items())
+            self.db.executemany("INSERT OR IGNORE INTO links VALUES (?, ?)",
+                    [(target, source) for target, sources in data['ids_that_link_to_id'].items()
+                        for source in sources])
+            self.db.executemany("INSERT OR IGNORE INTO do_not_convert VALUES (?)",
+                    [(t,) for t in data['do_not_convert']])
+            self.db.executemany("INSERT OR REPLACE INTO exported VALUES (?, ?, ?, ?)",
+                    [(doc_id, e['revid'], e['hash'], e['version'])
+                        for doc_id, e in data.get('exported', {}).items()])
+
+
+    def load(self):
+        with self.lock:
             self.title_to_id = {}
             self.id_to_title = {}
+            for title, doc_id in self.db.execute("SELECT title, doc_id FROM titles"):
+                self.title_to_id[title] = doc_id
+                self.id_to_title[doc_id] = title
+            self.file_to_id = dict(self.db.execute("SELECT title, file_id FROM files"))
+            # Reverse links, and the forward links we diff against when a
+            # doc's links change
             self.ids_that_link_to_id = {}
-            self.do_not_convert = []
-            self.file_to_id = {}
+            self.ids_linked_from_id = {}
+            for target, source in self.db.execute("SELECT target_id, source_id FROM links"):
+                self.ids_that_link_to_id.setdefault(target, set()).add(source)
+                self.ids_linked_from_id.setdefault(source, set()).add(target)
+            self.do_not_convert = [t for (t,) in self.db.execute("SELECT title FROM do_not_convert")]
+            self.exported = {}
+            for doc_id, revid, request_hash, version in self.db.execute("SELECT * FROM exported"):
+                self.exported[doc_id] = {
+                    'revid': revid,
+                    'hash': request_hash,
+                    'version': version,
+                }
+            self.reserved = set(doc_id for (doc_id,) in self.db.execute("SELECT doc_id FROM reserved"))
+
+
+    def write(self, sql, params=(), commit=False):
+        """
+        Run one write, and commit if asked to or if the batch is due.
+        """
+        with self.lock:
+            self.db.execute(sql, params)
+            self.pending_writes += 1
+            if commit or self.pending_writes >= COMMIT_EVERY or \
+                    time.monotonic() - self.last_commit > COMMIT_INTERVAL:
+                self.save()
+
 
     def save(self):
-        data = {
-            'title_to_id': self.title_to_id,
-            'id_to_title': self.id_to_title,
-            'ids_that_link_to_id': self.ids_that_link_to_id,
-            'do_not_convert': self.do_not_convert,
-            'file_to_id': self.file_to_id,
-        }
+        with self.lock:
+            self.db.commit()
+            self.pending_writes = 0
+            self.last_commit = time.monotonic()
 
-        with open(self.path, 'w') as f:
-            json.dump(data, f)
 
     def add(self, title, document_id):
         title = self.normalize(title)
-        self.title_to_id[title] = document_id
-        self.id_to_title[document_id] = title
-        self.save()
+        with self.lock:
+            self.title_to_id[title] = document_id
+            self.id_to_title[document_id] = title
+            self.write("INSERT OR REPLACE INTO titles VALUES (?, ?)", (title, document_id), commit=True)
+
+
+    def add_reserved(self, title, document_id):
+        """
+        Map `title` to an empty doc made ahead of converting it, see
+        `GDocDriver.reserve_docs`. It stays reserved until its first
+        export, so a later run still fills it in if this one stops first.
+        """
+        title = self.normalize(title)
+        with self.lock:
+            self.title_to_id[title] = document_id
+            self.id_to_title[document_id] = title
+            self.reserved.add(document_id)
+            self.db.execute("INSERT OR REPLACE INTO titles VALUES (?, ?)", (title, document_id))
+            self.write("INSERT OR IGNORE INTO reserved VALUES (?)", (document_id,), commit=True)
+
+
+    def is_reserved(self, document_id):
+        with self.lock:
+            return document_id in self.reserved
+
+
+    def has_title(self, title):
+        return self.get_id_for_title(title) is not None
+
+
+    def has_page(self, title):
+        return self.get_id_for_page(title) is not None
+
+
+    def items(self):
+        """
+        Return a snapshot list of (title, doc ID) pairs.
+        """
+        with self.lock:
+            return list(self.title_to_id.items())
+
+
+    def add_file(self, title, file_id):
+        with self.lock:
+            self.file_to_id[title] = file_id
+            self.write("INSERT OR REPLACE INTO files VALUES (?, ?)", (title, file_id), commit=True)
+
+
+    def get_file_id(self, title):
+        if title in self.file_to_id:
+            return self.file_to_id[title]
+        with self.lock:
+            # Another process may have uploaded it
+            row = self.db.execute("SELECT file_id FROM files WHERE title = ?", (title,)).fetchone()
+            if row is None:
+                return None
+            self.file_to_id[title] = row[0]
+            return row[0]
+
+
+    def set_links(self, source_id, target_ids):
+        """
+        Record that doc `source_id` now links to exactly `target_ids`.
+        Only the links that changed since last time get written.
+        """
+        target_ids = set(target_ids)
+        with self.lock:
+            previous = self.ids_linked_from_id.get(source_id, set())
+            for target_id in previous - target_ids:
+                sources = self.ids_that_link_to_id.get(target_id, set())
+                sources.discard(source_id)
+                if not sources:
+                    self.ids_that_link_to_id.pop(target_id, None)
+                self.write("DELETE FROM links WHERE target_id = ? AND source_id = ?", (target_id, source_id))
+            for target_id in target_ids - previous:
+                self.ids_that_link_to_id.setdefault(target_id, set()).add(source_id)
+                self.write("INSERT OR IGNORE INTO links VALUES (?, ?)", (target_id, source_id))
+            if target_ids:
+                self.ids_linked_from_id[source_id] = target_ids
+            else:
+                self.ids_linked_from_id.pop(source_id, None)
+
+
+    def record_export(self, document_id, revid, request_hash, version):
+        """
+        Remember what we last wrote into a doc: the wiki revision it came
+        from, a hash of the requests we sent, and the converter version.
+        """
+        with self.lock:
+            self.exported[document_id] = {
+                'revid': revid,
+                'hash': request_hash,
+                'version': version,
+            }
+            self.write("INSERT OR REPLACE INTO exported VALUES (?, ?, ?, ?)",
+                    (document_id, revid, request_hash, version))
+            if document_id in self.reserved:
+                self.reserved.discard(document_id)
+                self.write("DELETE FROM reserved WHERE doc_id = ?", (document_id,))
+
+    def record_export_progress(self, document_id, request_hash, chunks_done, revision_id):
+        """
+        Remember how far a chunked export into a doc got, and the doc
+        revision that left it at, so an interrupted export can pick up
+        from there. Committed right away since that's the point.
+        """
+        self.write("INSERT OR REPLACE INTO export_progress VALUES (?, ?, ?, ?)",
+                (document_id, request_hash, chunks_done, revision_id), commit=True)
+
+    def get_export_progress(self, document_id):
+        """
+        Return (request hash, chunks done, revision ID) for an unfinished
+        export into a doc, or None.
+        """
+        with self.lock:
+            return self.db.execute("SELECT hash, chunks_done, revision_id FROM export_progress "
+                    "WHERE doc_id = ?", (document_id,)).fetchone()
+
+    def clear_export_progress(self, document_id):
+        self.write("DELETE FROM export_progress WHERE doc_id = ?", (document_id,))
+
+    def is_export_current(self, document_id, revid, version):
+        """
+        Whether the doc was last exported from this exact wiki revision by
+        this converter version, so converting again would be a no-op.
+        """
+        last = self.exported.get(document_id)
+        return last is not None and last['revid'] == revid and last['version'] == version
+
+    def get_export_hash(self, document_id):
+        last = self.exported.get(document_id)
+        if last is None:
+            return None
+        return last['hash']
+
+    def record_link_check(self, document_id, modified_time):
+        """
+        Remember the Drive modifiedTime of a doc as of its last link check,
+        so the next pass can skip it if nobody has touched it since.
+        """
+        self.write("INSERT OR REPLACE INTO link_checks VALUES (?, ?)", (document_id, modified_time))
+
+    def get_link_checks(self):
+        """
+        Return a dict of doc ID → modifiedTime as of its last link check.
+        """
+        with self.lock:
+            return dict(self.db.execute("SELECT doc_id, modified_time FROM link_checks"))
+
+    def set_placeholders(self, document_id, titles):
+        """
+        Record the titles a doc still has `wiki://` placeholder links for,
+        because they had no doc yet.
+        """
+        with self.lock:
+            self.write("DELETE FROM placeholders WHERE doc_id = ?", (document_id,))
+            for title in set(self.canonical(t) for t in titles):
+                self.write("INSERT OR IGNORE INTO placeholders VALUES (?, ?)", (document_id, title))
+
+    def docs_with_placeholder(self, title):
+        """
+        Return the IDs of docs holding a placeholder for `title`.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT doc_id FROM placeholders WHERE title = ?",
+                    (self.canonical(title),))
+            return set(doc_id for (doc_id,) in rows)
+
+    def docs_with_resolvable_placeholders(self):
+        """
+        Return the IDs of docs holding placeholders for titles that have
+        since been mapped to a doc.
+        """
+        with self.lock:
+            rows = self.db.execute("SELECT DISTINCT p.doc_id FROM placeholders p "
+                    "JOIN titles t ON p.title = t.title")
+            return set(doc_id for (doc_id,) in rows)
 
-    
     def normalize(self, title):
-        # NOTE: Probably more stuff here
-        return title.replace("_", " ")
+        if self.resolver is not None:
+            return self.resolver.normalize(title)
+        return normalize_title(title)
+
+    def canonical(self, title):
+        """
+        The title of the page a link to `title` ends up on, following
+        redirects if we have a resolver.
+        """
+        if self.resolver is not None:
+            return self.resolver.resolve(title)
+        return self.normalize(title)
 
     def get_id_for_title(self, title):
+        """
+        The doc a link to `title` should point at, following redirects.
+        """
+        return self.get_id_for_page(self.canonical(title))
+
+    def get_id_for_page(self, title):
+        """
+        The doc that page `title` itself gets exported into. Doesn't follow
+        redirects, a redirect page isn't the page it redirects to.
+        """
         title = self.normalize(title)
         if title in self.title_to_id:
             return self.title_to_id[title]
-        else:
-            return None
+        with self.lock:
+            # Another process may have created it
+            row = self.db.execute("SELECT doc_id FROM titles WHERE title = ?", (title,)).fetchone()
+            if row is None:
+                return None
+            self.title_to_id[title] = row[0]
+            self.id_to_title[row[0]] = title
+            return row[0]
@@ -0,0 +1,125 @@
+import json
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from googleapiclient.errors import HttpError
+
+# Docs API write quota is 60 requests per minute per user, reads are 300.
+# We start a little under the write limit and let AIMD find the real ceiling.
+DOCS_RATE = 1.0
+DRIVE_RATE = 10.0
+
+# How many times to retry a single call that keeps getting rate limited
+MAX_RETRIES = 8
+
+RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded']
+
+# Server errors that are worth trying again
+TRANSIENT_STATUSES = [500, 502, 503, 504]
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every thread talking to one Google service.
+
+    The refill rate follows AIMD: every successful call nudges it up by
+    `increase` requests per second, and every rate limit response halves it
+    and pauses all callers, for `Retry-After` seconds if the server said so.
+    """
+
+    def __init__(self, name, rate, burst=None, min_rate=0.1, max_rate=None, increase=None):
+        self.name = name
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate or rate * 10
+        self.increase = increase or rate / 20
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+
+    def acquire(self, n=1):
+        """
+        Block until `n` requests worth of tokens are available and take them.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= n or self.tokens >= self.burst:
+                    # Batches bigger than the bucket just drain it
+                    self.tokens -= n
+                    return
+                else:
+                    wait = (min(n, self.burst) - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+    def succeeded(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+
+    def rate_limited(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            if retry_after is None:
+                retry_after = 1.0 / self.rate
+            self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+            logging.info(f"Rate limited by {self.name}, backing off {retry_after:.1f}s "
+                    f"and dropping to {self.rate:.2f} requests/s")
+
+
+def is_rate_limited(e):
+    """
+    Whether an HttpError is a quota response we should back off and retry.
+    """
+    if not isinstance(e, HttpError):
+        return False
+    if e.resp.status == 429:
+        return True
+    if e.resp.status == 403:
+        try:
+            errors = json.loads(e.content).get('error', {}).get('errors', [])
+        except (ValueError, AttributeError):
+            return False
+        return any(x.get('reason') in RATE_LIMIT_REASONS for x in errors)
+    return False
+
+
+def is_transient(e):
+    """
+    Whether an HttpError is a server hiccup that may work if retried.
+    """
+    return isinstance(e, HttpError) and e.resp.status in TRANSIENT_STATUSES
+
+
+def retry_after(e):
+    """
+    Seconds the server asked us to wait, if it said.
+    """
+    value = e.resp.get('retry-after')
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    # It's allowed to be an HTTP date, too
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
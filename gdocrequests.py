@@ -0,0 +1,130 @@
+import json
+import logging
+
+# Bounds on one batchUpdate, well under what the Docs API accepts
+MAX_CHUNK_REQUESTS = 500
+MAX_CHUNK_BYTES = 1024 * 1024
+
+def flatten_requests(requests):
+    """
+    The converter builds requests in nested lists so groups of them keep
+    their order when the whole list gets reversed. Flatten them all the way
+    down, in order.
+    """
+    flat = []
+    stack = [iter(requests)]
+    while stack:
+        for r in stack[-1]:
+            if isinstance(r, list):
+                stack.append(iter(r))
+                break
+            flat.append(r)
+        else:
+            stack.pop()
+    return flat
+
+
+def styled_insert(requests, i):
+    """
+    If requests[i] and requests[i+1] are an insertText and an
+    updateTextStyle covering exactly the inserted text, return
+    (index, text, style request), else None.
+    """
+    if i + 1 >= len(requests):
+        return None
+    insert = requests[i].get('insertText')
+    update = requests[i + 1].get('updateTextStyle')
+    if insert is None or update is None:
+        return None
+    location = insert['location']
+    text_range = update['range']
+    if 'segmentId' in location or 'segmentId' in text_range:
+        return None
+    idx = location['index']
+    if text_range['startIndex'] != idx or text_range['endIndex'] != idx + len(insert['text']):
+        return None
+    return idx, insert['text'], update
+
+
+def same_style(a, b):
+    return a['textStyle'] == b['textStyle'] and a['fields'] == b['fields']
+
+
+def merge_styled_inserts(requests):
+    """
+    Merge runs of insertText + updateTextStyle pairs that insert at the
+    same index with the same style into one pair. Since each insert goes in
+    front of the last one, the merged text is the later text followed by
+    the earlier.
+    """
+    merged = []
+    i = 0
+    while i < len(requests):
+        first = styled_insert(requests, i)
+        if first is None:
+            merged.append(requests[i])
+            i += 1
+            continue
+
+        idx, text, update = first
+        i += 2
+        while True:
+            following = styled_insert(requests, i)
+            if following is None or following[0] != idx or not same_style(following[2], update):
+                break
+            text = following[1] + text
+            i += 2
+
+        merged.append({
+            'insertText': {
+                'location': {
+                    'index': idx,
+                },
+                'text': text
+            }
+        })
+        merged.append({
+            'updateTextStyle': {
+                'range': {
+                    'startIndex': idx,
+                    'endIndex': idx + len(text)
+                },
+                'textStyle': update['textStyle'],
+                'fields': update['fields']
+            }
+        })
+    return merged
+
+
+def optimize_requests(requests):
+    """
+    Shrink a flat list of Docs batchUpdate requests without changing what
+    they do to the doc. For now that's merging same-styled text inserts,
+    see `merge_styled_inserts`.
+    """
+    optimized = merge_styled_inserts(requests)
+    logging.debug(f"Optimized {len(requests)} requests down to {len(optimized)}")
+    return optimized
+
+
+def chunk_requests(requests, max_requests=MAX_CHUNK_REQUESTS, max_bytes=MAX_CHUNK_BYTES):
+    """
+    Split requests into chunks of at most `max_requests` requests and
+    about `max_bytes` of JSON each. Sending the chunks one after another
+    does the same as sending them all at once, since a batchUpdate applies
+    its requests in order anyway.
+    """
+    chunks = []
+    chunk = []
+    size = 0
+    for r in requests:
+        r_size = len(json.dumps(r))
+        if chunk and (len(chunk) >= max_requests or size + r_size > max_bytes):
+            chunks.append(chunk)
+            chunk = []
+            size = 0
+        chunk.append(r)
+        size += r_size
+    if chunk:
+        chunks.append(chunk)
+    return chunks
@@ -0,0 +1,55 @@
+import json
+import sqlite3
+import threading
+import zlib
+
+class DocSnapshots:
+    """
+    Local store of Docs API document JSON, zlib compressed, keyed by doc ID
+    and the revisionId it was read at. A snapshot is only good while the
+    doc is still at that revision, so readers check the current revision
+    first (see `GDocDriver.get_document`).
+    """
+
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                doc_id TEXT PRIMARY KEY,
+                revision_id TEXT NOT NULL,
+                data BLOB NOT NULL
+            );
+        """)
+
+
+    def get(self, doc_id, revision_id):
+        """
+        Return the saved document if we have it at `revision_id`, else None.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT data FROM snapshots WHERE doc_id = ? AND revision_id = ?",
+                    (doc_id, revision_id)).fetchone()
+        if row is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+
+    def put(self, document, revision_id=None):
+        """
+        Save `document`, at its own revisionId unless `revision_id` says
+        it's been patched up to a newer one.
+        """
+        revision_id = revision_id or document['revisionId']
+        document['revisionId'] = revision_id
+        data = zlib.compress(json.dumps(document, separators=(',', ':')).encode('utf-8'))
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)",
+                    (document['documentId'], revision_id, data))
+            self.db.commit()
+
+
+    def discard(self, doc_id):
+        with self.lock:
+            self.db.execute("DELETE FROM snapshots WHERE doc_id = ?", (doc_id,))
+            self.db.commit()
@@ -0,0 +1,60 @@
+def iter_segments(document):
+    """
+    Yield (segment ID, content list) for the body, headers, footers and
+    footnotes of a Docs API document. The body's segment ID is None.
+    """
+    yield None, document.get('body', {}).get('content', [])
+    for key in ('headers', 'footers', 'footnotes'):
+        for segment_id, segment in document.get(key, {}).items():
+            yield segment_id, segment.get('content', [])
+
+
+def iter_text_runs(document):
+    """
+    Yield (segment ID, paragraph element) for every text run in a Docs API
+    document.
+
+    Only follows the parts of the document that can hold text: paragraphs,
+    and tables and tables of contents that hold more of them. Walks with an
+    explicit stack so deeply nested tables don't hit the recursion limit.
+    """
+    for segment_id, content in iter_segments(document):
+        # Reversed so we pop elements off in document order
+        stack = list(reversed(content))
+        while stack:
+            element = stack.pop()
+            if 'paragraph' in element:
+                for e in element['paragraph'].get('elements', []):
+                    if 'textRun' in e:
+                        yield segment_id, e
+            elif 'table' in element:
+                cells = []
+                for row in element['table'].get('tableRows', []):
+                    for cell in row.get('tableCells', []):
+                        cells.extend(cell.get('content', []))
+                stack.extend(reversed(cells))
+            elif 'tableOfContents' in element:
+                stack.extend(reversed(element['tableOfContents'].get('content', [])))
+
+
+def iter_links(document):
+    """
+    Yield (segment ID, start index, end index, url) for every linked text
+    run in a Docs API document.
+    """
+    for segment_id, e in iter_text_runs(document):
+        url = e['textRun'].get('textStyle', {}).get('link', {}).get('url')
+        if url is not None:
+            yield segment_id, e.get('startIndex', 0), e.get('endIndex', 0), url
+
+
+def patch_links(document, links):
+    """
+    Apply link changes to a document's JSON in place, like our
+    `updateTextStyle` requests did to the doc itself. `links` maps
+    (segment ID, start index, end index) to the new url.
+    """
+    for segment_id, e in iter_text_runs(document):
+        key = (segment_id, e.get('startIndex', 0), e.get('endIndex', 0))
+        if key in links:
+            e['textRun'].setdefault('textStyle', {})['link'] = {'url': links[key]}
@@ -0,0 +1,180 @@
+import logging
+import sqlite3
+import threading
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+DOCUMENT_MIME_TYPE = 'application/vnd.google-apps.document'
+
+FILE_FIELDS = "id, name, mimeType, parents, modifiedTime, trashed"
+
+# SQLite has a limit on how many ? parameters go in one statement
+MAX_PARAMETERS = 500
+
+class DriveMirror:
+    """
+    Local SQLite copy of the files and folders in a shared drive, so
+    folder-scoped lookups are local queries instead of drive-wide listings.
+
+    The first sync lists the whole drive. After that, `sync` only reads the
+    Drive changes feed from the page token stored with the mirror.
+    """
+
+    def __init__(self, path, driver, drive_id):
+        self.driver = driver
+        self.drive_id = drive_id
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id TEXT PRIMARY KEY,
+                name TEXT,
+                mime_type TEXT,
+                parent TEXT,
+                modified_time TEXT
+            );
+            CREATE INDEX IF NOT EXISTS files_parent ON files (parent);
+            CREATE INDEX IF NOT EXISTS files_mime_type ON files (mime_type);
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+        """)
+        self.synced = False
+
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+
+    def sync(self):
+        """
+        Bring the mirror up to date. Only does work the first time it's
+        called in a run.
+        """
+        with self.lock:
+            if self.synced:
+                return
+            token = self.get_meta('page_token')
+            if token is None or self.get_meta('drive_id') != self.drive_id:
+                self.full_sync()
+            else:
+                self.apply_changes(token)
+            self.db.commit()
+            self.synced = True
+
+
+    def full_sync(self):
+        logging.info(f"Building local mirror of drive {self.drive_id}")
+        # Get the token first so nothing that changes during the listing
+        # gets missed
+        drive = self.driver.drive
+        token = self.driver.execute(drive.changes().getStartPageToken(
+            driveId=self.drive_id,
+            supportsAllDrives=True))['startPageToken']
+
+        self.db.execute("DELETE FROM files")
+        page_token = None
+        while True:
+            results = self.driver.execute(drive.files().list(
+                pageSize=1000,
+                fields=f"nextPageToken, files({FILE_FIELDS})",
+                includeItemsFromAllDrives=True, supportsAllDrives=True,
+                corpora='drive',
+                driveId=self.drive_id,
+                pageToken=page_token,
+                q="trashed = false"))
+            for f in results.get('files', []):
+                self.upsert(f)
+            page_token = results.get('nextPageToken', None)
+            if page_token is None:
+                break
+
+        self.set_meta('drive_id', self.drive_id)
+        self.set_meta('page_token', token)
+
+
+    def apply_changes(self, token):
+        drive = self.driver.drive
+        count = 0
+        while True:
+            results = self.driver.execute(drive.changes().list(
+                pageToken=token,
+                pageSize=1000,
+                driveId=self.drive_id,
+                includeItemsFromAllDrives=True, supportsAllDrives=True,
+                fields=f"nextPageToken, newStartPageToken, changes(changeType, fileId, removed, file({FILE_FIELDS}))"))
+            for change in results.get('changes', []):
+                # Changes to the shared drive itself, like a rename, come
+                # through here too but aren't about any file
+                if change.get('changeType', 'file') != 'file' or not 'fileId' in change:
+                    continue
+                count += 1
+                f = change.get('file')
+                if change.get('removed') or f is None or f.get('trashed'):
+                    self.db.execute("DELETE FROM files WHERE id = ?", (change['fileId'],))
+                else:
+                    self.upsert(f)
+            if 'newStartPageToken' in results:
+                self.set_meta('page_token', results['newStartPageToken'])
+                break
+            token = results['nextPageToken']
+        logging.info(f"Applied {count} changes to local mirror of drive {self.drive_id}")
+
+
+    def upsert(self, f):
+        parents = f.get('parents') or [None]
+        self.db.execute("INSERT OR REPLACE INTO files (id, name, mime_type, parent, modified_time) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (f['id'], f.get('name'), f.get('mimeType'), parents[0], f.get('modifiedTime')))
+
+
+    def folders(self):
+        """
+        Return dicts of folder ID → parent ID and folder ID → name.
+        """
+        self.sync()
+        parents = {}
+        names = {}
+        with self.lock:
+            rows = self.db.execute("SELECT id, parent, name FROM files WHERE mime_type = ?",
+                    (FOLDER_MIME_TYPE,)).fetchall()
+        for folder_id, parent_id, name in rows:
+            parents[folder_id] = parent_id
+            names[folder_id] = name
+        return parents, names
+
+
+    def files_in_folders(self, folder_ids):
+        """
+        Return a dict of file ID → name for everything that isn't a folder
+        directly inside any of `folder_ids`.
+        """
+        self.sync()
+        folder_ids = list(folder_ids)
+        files = {}
+        with self.lock:
+            for start in range(0, len(folder_ids), MAX_PARAMETERS):
+                chunk = folder_ids[start:start + MAX_PARAMETERS]
+                placeholders = ", ".join("?" for _ in chunk)
+                rows = self.db.execute(f"SELECT id, name FROM files WHERE mime_type != ? "
+                        f"AND parent IN ({placeholders})", [FOLDER_MIME_TYPE] + chunk).fetchall()
+                files.update(rows)
+        return files
+
+
+    def modified_times(self, mime_type=DOCUMENT_MIME_TYPE):
+        """
+        Return a dict of file ID → modifiedTime string for every file of
+        `mime_type`.
+        """
+        self.sync()
+        with self.lock:
+            rows = self.db.execute("SELECT id, modified_time FROM files WHERE mime_type = ?",
+                    (mime_type,)).fetchall()
+        return dict(rows)
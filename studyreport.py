@@ -3,7 +3,51 @@ import mwparserfromhell
 import logging
 import re
 import csv
+import json
+import sqlite3
+import os
+from concurrent.futures import ThreadPoolExecutor
 from utilities import study_template
+import artifacts
+
+COLUMNS = [
+    "Study",
+    "AKA",
+    "Short Description",
+    "Study Status",
+    "Active",
+    "In Quarterly Progress Report",
+    "Verified for Progress Report Date",
+    "Funded Fully or Partially Through RSP",
+    "CHM Website",
+    "Start Date",
+    "End Date",
+    "Planning Start Date",
+    "Piloting Start Date",
+    "Collecting Start Date",
+    "Projected Enrollment",
+    "Current Enrollment",
+    "IRB Number",
+    "Grant Number",
+    "Funding Source",
+    "ARROW URL",
+    "NIH RePORTER ID",
+    "ClinicalTrials.Gov",
+    "JARVIS ID",
+    "PIs",
+    "Project Manager",
+    "Current Contact",
+    "Project Links",
+    ]
+
+# Columns that downstream tooling filters on, so they get an index in SQLite
+INDEXED_COLUMNS = ["Study Status", "Active", "In Quarterly Progress Report"]
+
+# How many pages to fetch and parse at once
+DEFAULT_WORKERS = 8
+
+# How many rows to buffer before writing a Parquet row group
+PARQUET_BATCH_SIZE = 256
 
 def fetch(page, template, key):
     thing = ""
@@ -14,50 +58,190 @@ def fetch(page, template, key):
         pass
     return thing
 
-def run(mother):
+
+def page_to_row(page):
+    """
+    Fetch and parse one study page into a row of column values.
+    """
+    logging.debug(f"Loading study {page.name}")
+    text = page.text()
+    p = mwparserfromhell.parse(text)
+
+    template = study_template(p)
+    if template is None:
+        logging.warning(f"No study template on study page {page.name}")
+        column_values = [""] * len(COLUMNS)
+    else:
+        column_values = [fetch(page, template, x) for x in COLUMNS]
+    column_values[0] = page.name
+    return column_values
+
+
+class ReportWriter:
+    """
+    Base for the report formats. Subclasses write to `self.temp_path` and
+    implement `close`; `finish` then swaps the file into place if it
+    changed, and `abort` throws it away.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.temp_path = artifacts.temp_path_for(path)
+
+    def finish(self):
+        self.close()
+        artifacts.replace_if_changed(self.temp_path, self.path)
+
+    def abort(self):
+        try:
+            self.close()
+        finally:
+            os.remove(self.temp_path)
+
+
+class CsvReportWriter(ReportWriter):
+    extension = "csv"
+
+    def __init__(self, path, columns):
+        super().__init__(path)
+        self.f = open(self.temp_path, 'w', newline='')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(columns)
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.f.close()
+
+
+class JsonLinesReportWriter(ReportWriter):
+    extension = "jsonl"
+
+    def __init__(self, path, columns):
+        super().__init__(path)
+        self.f = open(self.temp_path, 'w')
+        self.columns = columns
+
+    def write(self, row):
+        self.f.write(json.dumps(dict(zip(self.columns, row))))
+        self.f.write("\n")
+
+    def close(self):
+        self.f.close()
+
+
+class ParquetReportWriter(ReportWriter):
+    """
+    Writes row groups of `PARQUET_BATCH_SIZE` rows as they come in, so we
+    never hold the whole report in memory. Needs pyarrow installed.
+    """
+    extension = "parquet"
+
+    def __init__(self, path, columns):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Parquet output needs pyarrow, try `pip3 install pyarrow`")
+
+        super().__init__(path)
+        self.pa = pyarrow
+        self.columns = columns
+        self.schema = pyarrow.schema([(c, pyarrow.string()) for c in columns])
+        self.writer = pyarrow.parquet.ParquetWriter(self.temp_path, self.schema)
+        self.batch = []
+
+    def write(self, row):
+        self.batch.append(row)
+        if len(self.batch) >= PARQUET_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if not self.batch:
+            return
+        arrays = [self.pa.array([r[i] for r in self.batch], type=self.pa.string())
+                for i in range(len(self.columns))]
+        self.writer.write_table(self.pa.Table.from_arrays(arrays, schema=self.schema))
+        self.batch = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+class SqliteReportWriter(ReportWriter):
+    """
+    Writes a `studies` table with one text column per report column,
+    indexed on the study name and the columns in `INDEXED_COLUMNS`.
+    """
+    extension = "sqlite"
+
+    def __init__(self, path, columns):
+        super().__init__(path)
+        self.db = sqlite3.connect(self.temp_path)
+        quoted = [self.quote(c) for c in columns]
+        self.db.execute("CREATE TABLE studies ({})".format(
+            ", ".join(f"{q} TEXT" for q in quoted)))
+        self.insert = "INSERT INTO studies VALUES ({})".format(
+            ", ".join("?" for _ in columns))
+        self.index_columns = [columns[0]] + INDEXED_COLUMNS
+
+    def quote(self, name):
+        return '"' + name.replace('"', '""') + '"'
+
+    def write(self, row):
+        self.db.execute(self.insert, row)
+
+    def close(self):
+        for c in self.index_columns:
+            index_name = "studies_" + re.sub(r'\W+', '_', c).lower()
+            self.db.execute(f"CREATE INDEX {index_name} ON studies ({self.quote(c)})")
+        self.db.commit()
+        self.db.close()
+
+
+WRITERS = {
+    'csv': CsvReportWriter,
+    'jsonl': JsonLinesReportWriter,
+    'parquet': ParquetReportWriter,
+    'sqlite': SqliteReportWriter,
+}
+
+
+def run(mother, formats=None, output_dir=".", workers=DEFAULT_WORKERS):
+    """
+    Fetch and parse every page in Category:Study in parallel, writing rows
+    to `studyreport.<format>` in `output_dir` for each of `formats` as they
+    complete.
+
+    Rows are still written in category order, so output is deterministic,
+    and files are only replaced if the report changed.
+    """
+    if not formats:
+        formats = ['csv']
+
+    for f in formats:
+        if not f in WRITERS:
+            raise ValueError(f"Unknown study report format '{f}', try one of {', '.join(WRITERS)}")
+
+    os.makedirs(output_dir, exist_ok=True)
     category = mother.categories['Study']
 
-    with open('studyreport.csv', 'w') as csvfile:
-        writer = csv.writer(csvfile)
-        columns = [
-            "Study",
-            "AKA",
-            "Short Description",
-            "Study Status",
-            "Active",
-            "In Quarterly Progress Report",
-            "Verified for Progress Report Date",
-            "Funded Fully or Partially Through RSP",
-            "CHM Website",
-            "Start Date",
-            "End Date",
-            "Planning Start Date",
-            "Piloting Start Date",
-            "Collecting Start Date",
-            "Projected Enrollment",
-            "Current Enrollment",
-            "IRB Number",
-            "Grant Number",
-            "Funding Source",
-            "ARROW URL",
-            "NIH RePORTER ID",
-            "ClinicalTrials.Gov",
-            "JARVIS ID",
-            "PIs",
-            "Project Manager",
-            "Current Contact",
-            "Project Links",
-            ]
-
-        writer.writerow(columns)
-        for page in category:
-            logging.debug("Loading study", page.name)
-            text = page.text()
-            p = mwparserfromhell.parse(text)
-
-            template = study_template(p)
-            column_values = [fetch(page, template, x) for x in columns]
-            column_values[0] = page.name
-
-            writer.writerow(column_values)
+    writers = []
+    try:
+        # Inside the try, so if one writer can't start (say parquet without
+        # pyarrow) the temp files of the ones before it get cleaned up
+        for f in formats:
+            writers.append(WRITERS[f](os.path.join(output_dir, f"studyreport.{WRITERS[f].extension}"), COLUMNS))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # `map` hands results back in submission order
+            for row in executor.map(page_to_row, category):
+                for writer in writers:
+                    writer.write(row)
+    except BaseException:
+        for writer in writers:
+            writer.abort()
+        raise
 
+    for writer in writers:
+        writer.finish()
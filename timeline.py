@@ -5,15 +5,23 @@ import re
 from datetime import date, datetime
 from dateutil.relativedelta import relativedelta
 from collections import defaultdict
-from functools import reduce
+from functools import reduce, lru_cache
 import operator
 import sys
+import numpy as np
+import json
+import gzip
+import artifacts
+import os
+from html import escape
 
 today = datetime.today()
 ten_months = relativedelta(months=10)
 six_months = relativedelta(months=6)
 two_months = relativedelta(months=2)
 
+DEFAULT_OUTPUT_DIR = "/home/dfitch/pub_html/timeline"
+
 WIKI_URL = "https://wiki.keck.waisman.wisc.edu/wikis/mother/index.php"
 
 TO_EXTRACT = {
@@ -30,6 +38,13 @@ TO_EXTRACT = {
     ],
 }
 
+BAR_DTYPE = np.dtype([
+    ('item', object),
+    ('kind', object),
+    ('start', 'datetime64[D]'),
+    ('end', 'datetime64[D]'),
+])
+
 def color_for_bar_kind(bar_kind):
     if bar_kind == "Planning":
         return '#dae'
@@ -43,23 +58,72 @@ def color_for_bar_kind(bar_kind):
         return '#ade'
     return '#ccc'
 
-def append_rows(normal_rows, truncated_rows, study, bar_kind, s, e):
-    color = color_for_bar_kind(bar_kind)
-
-    normal_rows.append("[ '{0}', '{1}', '{2}', new Date({3}, {4}, {5}), new Date({6}, {7}, {8})]".format(
-            study, bar_kind, color, s.year, s.month, s.day, e.year, e.month, e.day))
-
-    if e <= today - two_months or s >= today + ten_months:
-        return
-    if e >= today + ten_months:
-        e = today + ten_months
-    if s <= today - two_months:
-        s = today - two_months
-
-    truncated_rows.append("[ '{0}', '{1}', '{2}', new Date({3}, {4}, {5}), new Date({6}, {7}, {8})]".format(
-            study, bar_kind, color, s.year, s.month, s.day, e.year, e.month, e.day))
-
-def make_html(title, markup):
+def to_day(d):
+    return np.datetime64(d.date(), 'D')
+
+def make_bar_table(bars):
+    """
+    Turn a list of (item, bar kind, start, end) tuples into a structured
+    NumPy array so we can clip and format it all at once.
+    """
+    table = np.empty(len(bars), dtype=BAR_DTYPE)
+    if bars:
+        items, kinds, starts, ends = zip(*bars)
+        table['item'] = items
+        table['kind'] = kinds
+        table['start'] = [to_day(s) for s in starts]
+        table['end'] = [to_day(e) for e in ends]
+    return table
+
+def clip_bars(table, window_start, window_end):
+    """
+    Return only the bars that overlap the window, with their ends clamped
+    to the window.
+    """
+    window_start = to_day(window_start)
+    window_end = to_day(window_end)
+    keep = (table['end'] > window_start) & (table['start'] < window_end)
+    clipped = table[keep]
+    clipped['start'] = np.maximum(clipped['start'], window_start)
+    clipped['end'] = np.minimum(clipped['end'], window_end)
+    return clipped
+
+def bars_to_data(table):
+    """
+    Turn the bar table into compact JSON-ready rows of
+    [item, bar kind, color, [y, m, d], [y, m, d]] for the chart page.
+    Months are 0-based, since that's what JavaScript's `new Date` takes.
+    """
+    starts = table['start'].astype(object)
+    ends = table['end'].astype(object)
+    return [[item, kind, color_for_bar_kind(kind),
+            [s.year, s.month - 1, s.day], [e.year, e.month - 1, e.day]]
+        for item, kind, s, e in zip(table['item'], table['kind'], starts, ends)]
+
+def build_data(table, warnings):
+    """
+    Build the JSON data file contents for one category's bar table.
+    """
+    data = {
+        'all': bars_to_data(table),
+        'near': bars_to_data(clip_bars(table, today - two_months, today + ten_months)),
+        'warnings': warnings,
+    }
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+def write_data(output_dir, category_name, content):
+    """
+    Write `<category>.json` plus a pre-compressed `<category>.json.gz` for
+    servers that can serve it directly.
+    """
+    path = os.path.join(output_dir, f"{category_name}.json")
+    artifacts.write_if_changed(path, content)
+    # mtime=0 so the same data always compresses to the same bytes
+    artifacts.write_if_changed(path + ".gz", gzip.compress(content, mtime=0))
+
+CHARTS_SCRIPT = '<script type="text/javascript" src="https://www.gstatic.com/charts/loader.js"></script>'
+
+def make_html(title, markup, charts=True):
     return \
 """
 <!DOCTYPE html>
@@ -73,6 +137,11 @@ body {
   background-color: #eee;
 }
 
+.static-timeline {
+  display: flex;
+  width: max-content;
+}
+
 .timeline-wrapper {
   overflow-x: scroll;
   overflow-y: scroll;
@@ -114,82 +183,213 @@ table thead th:first-child {
 }
 
 </style>
-<script type="text/javascript" src="https://www.gstatic.com/charts/loader.js"></script>
+""" + (CHARTS_SCRIPT if charts else "") + """
 </head>
 <body>
 """  + markup + "</body></html>"
 
-def build_chart(category_name, chart_items, warnings, links=""):
-    normal_rows = []
-    truncated_rows = []
+SVG_DAY_WIDTH = 2
+SVG_ROW_HEIGHT = 22
+SVG_AXIS_HEIGHT = 24
+SVG_LABEL_WIDTH = 300
+
+def render_svg(table):
+    """
+    Lay out every bar in the table once, in pixel coordinates where x=0 is
+    January 1 of the earliest year. One lane per item, in order of first
+    appearance, like the Google chart.
+
+    Returns (elements, origin, lanes) where elements is a list of
+    (x_start, x_end, svg markup) so tiles and crops can pick what they need.
+    """
+    if len(table) == 0:
+        return [], np.datetime64(today.date(), 'Y').astype('datetime64[D]'), []
+
+    origin = table['start'].min().astype('datetime64[Y]').astype('datetime64[D]')
+    lanes = list(dict.fromkeys(table['item']))
+    lane_of = {item: i for i, item in enumerate(lanes)}
+
+    x0 = (table['start'] - origin).astype(int) * SVG_DAY_WIDTH
+    x1 = (table['end'] - origin).astype(int) * SVG_DAY_WIDTH
+    y = np.array([lane_of[item] for item in table['item']], dtype=int) * SVG_ROW_HEIGHT + SVG_AXIS_HEIGHT
+
+    elements = []
+    for item, kind, a, b, top in zip(table['item'], table['kind'], x0, x1, y):
+        width = max(b - a, 1)
+        elements.append((a, a + width,
+            f'<g><title>{escape(item)}: {escape(kind)}</title>'
+            f'<rect x="{a}" y="{top + 2}" width="{width}" height="{SVG_ROW_HEIGHT - 4}" '
+            f'fill="{color_for_bar_kind(kind)}" stroke="#888"/>'
+            f'<text x="{a + 3}" y="{top + SVG_ROW_HEIGHT - 7}">{escape(kind)}</text></g>'))
+    return elements, origin, lanes
+
+def svg_axis(origin, start, end):
+    """
+    Year and month grid lines between two datetime64[D] days.
+    """
+    markup = []
+    month = start.astype('datetime64[M]')
+    while month.astype('datetime64[D]') < end:
+        day = month.astype('datetime64[D]')
+        if day >= start:
+            x = (day - origin).astype(int) * SVG_DAY_WIDTH
+            is_year = month.astype(object).month == 1
+            markup.append(f'<line x1="{x}" y1="0" x2="{x}" y2="100%" stroke="{"#888" if is_year else "#ddd"}"/>')
+            label = str(month.astype('datetime64[Y]')) if is_year else month.astype(object).strftime("%b")
+            markup.append(f'<text x="{x + 3}" y="16">{label}</text>')
+        month += 1
+    return "".join(markup)
+
+def svg_crop(elements, origin, lanes, start, end):
+    """
+    Crop the shared render to the days between `start` and `end` with
+    a viewBox, including only the elements that are visible.
+    """
+    x_start = (start - origin).astype(int) * SVG_DAY_WIDTH
+    x_end = (end - origin).astype(int) * SVG_DAY_WIDTH
+    width = x_end - x_start
+    height = len(lanes) * SVG_ROW_HEIGHT + SVG_AXIS_HEIGHT
+    visible = [markup for a, b, markup in elements if b > x_start and a < x_end]
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{width}" height="{height}" '
+        f'viewBox="{x_start} 0 {width} {height}" font-family="sans-serif" font-size="11">'
+        + svg_axis(origin, start, end) + "".join(visible) + "</svg>")
+
+def svg_labels(lanes):
+    height = len(lanes) * SVG_ROW_HEIGHT + SVG_AXIS_HEIGHT
+    labels = [f'<text x="4" y="{SVG_AXIS_HEIGHT + i * SVG_ROW_HEIGHT + SVG_ROW_HEIGHT - 7}">{escape(item)}</text>'
+        for i, item in enumerate(lanes)]
+    return (f'<svg xmlns="http://www.w3.org/2000/svg" width="{SVG_LABEL_WIDTH}" height="{height}" '
+        f'font-family="sans-serif" font-size="11">' + "".join(labels) + "</svg>")
+
+def write_static(output_dir, name, title, table, links=""):
+    """
+    Write a static SVG version of a timeline: a label column, one tile per
+    year of the full history, and a crop for the near future, plus an HTML
+    page that shows them without any scripts.
+
+    The near future gets its own render with only the items that have a
+    bar in it, so it isn't mostly empty lanes. Year tiles left over from
+    earlier runs that no longer cover any bars get deleted.
+    """
+    elements, origin, lanes = render_svg(table)
+    written = set()
+
+    def write_svg(filename, markup):
+        artifacts.write_if_changed(os.path.join(output_dir, filename), markup)
+        written.add(filename)
+        return f"<img src='{filename}'/>"
+
+    labels = write_svg(f"{name}_labels.svg", svg_labels(lanes))
+
+    near_table = clip_bars(table, today - two_months, today + ten_months)
+    near_elements, near_origin, near_lanes = render_svg(near_table)
+    near_labels = write_svg(f"{name}_near_labels.svg", svg_labels(near_lanes))
+    near = write_svg(f"{name}_near.svg", svg_crop(near_elements, near_origin, near_lanes,
+        to_day(today - two_months), to_day(today + ten_months)))
+
+    tiles = []
+    if len(table) > 0:
+        first = int(str(table['start'].min().astype('datetime64[Y]')))
+        last = int(str(table['end'].max().astype('datetime64[Y]')))
+        for year in range(first, last + 1):
+            tiles.append(write_svg(f"{name}_{year}.svg", svg_crop(elements, origin, lanes,
+                np.datetime64(f"{year}-01-01"), np.datetime64(f"{year + 1}-01-01"))))
+
+    tile_regex = re.compile(re.escape(name) + r'_\d+\.svg')
+    for filename in os.listdir(output_dir):
+        if tile_regex.fullmatch(filename) and not filename in written:
+            logging.info(f"Removing stale timeline tile {filename}")
+            os.remove(os.path.join(output_dir, filename))
+
+    markup = links + f"""
+<h1>Near Future</h1>
+<div class="timeline-wrapper"><div class="static-timeline">{near_labels}{near}</div></div>
+
+<h1>Entire History</h1>
+<div class="timeline-wrapper"><div class="static-timeline">{labels}{"".join(tiles)}</div></div>
+"""
+    artifacts.write_if_changed(os.path.join(output_dir, f"{name}_static.html"),
+            make_html(title, markup, charts=False))
+
+
+def collect_bars(chart_items):
+    """
+    Decide which bars each item gets based on which dates it has, returning
+    a list of (item, bar kind, start, end) tuples.
+    """
+    bars = []
     for item, dates in chart_items.items():
+        def add(bar_kind, s, e):
+            # Some fallbacks reach for dates the item doesn't have
+            if s and e:
+                bars.append((item, bar_kind, s, e))
+
         bar_added = False
         if dates['Planning Start Date']:
             bar_added = True
             # Could be a project or a study
             if dates['Project Start Date']:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Planning', dates['Planning Start Date'], dates['Project Start Date'])
-
+                add('Planning', dates['Planning Start Date'], dates['Project Start Date'])
             elif dates['Piloting Start Date']:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Planning', dates['Planning Start Date'], dates['Piloting Start Date'])
+                add('Planning', dates['Planning Start Date'], dates['Piloting Start Date'])
             else:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Planning with No Piloting Start', dates['Planning Start Date'], today + six_months)
+                add('Planning with No Piloting Start', dates['Planning Start Date'], today + six_months)
 
         if dates['Project Start Date']:
             bar_added = True
             if dates['Project End Date']:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Project', dates['Project Start Date'], dates['Project End Date'])
+                add('Project', dates['Project Start Date'], dates['Project End Date'])
             else:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Project with No End Date', dates['Project Start Date'], today + six_months)
+                add('Project with No End Date', dates['Project Start Date'], today + six_months)
 
         if dates['Piloting Start Date']:
             bar_added = True
             if dates['Collecting Start Date']:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Piloting', dates['Piloting Start Date'], dates['Collecting Start Date'])
+                add('Piloting', dates['Piloting Start Date'], dates['Collecting Start Date'])
             else:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Piloting with No Collection Start', dates['Piloting Start Date'], today + six_months)
+                add('Piloting with No Collection Start', dates['Piloting Start Date'], today + six_months)
 
         if dates['Collecting Start Date']:
             bar_added = True
             if dates['Collecting End Date']:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Collecting', dates['Collecting Start Date'], dates['Collecting End Date'])
+                add('Collecting', dates['Collecting Start Date'], dates['Collecting End Date'])
             elif dates['End Date']:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Collecting', dates['Collecting Start Date'], dates['End Date'])
+                add('Collecting', dates['Collecting Start Date'], dates['End Date'])
             else:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Piloting with No Collection Start', dates['Piloting Start Date'], today + six_months)
+                add('Piloting with No Collection Start', dates['Piloting Start Date'], today + six_months)
 
         if dates['Collecting End Date']:
             bar_added = True
-            append_rows(normal_rows, truncated_rows, item,
-                    'Wrapping Up', dates['Collecting End Date'], dates['End Date'])
+            add('Wrapping Up', dates['Collecting End Date'], dates['End Date'])
 
         # Grants
         if dates['Letter of Intent Due']:
             bar_added = True
             if dates['Submission Date']:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Writing', dates['Letter of Intent Due'], dates['Submission Date'])
+                add('Writing', dates['Letter of Intent Due'], dates['Submission Date'])
             else:
-                append_rows(normal_rows, truncated_rows, item,
-                        'Grant with No Submission Date', dates['Letter of Intent Due'], dates['Letter of Intent Due'] + six_months)
+                add('Grant with No Submission Date', dates['Letter of Intent Due'], dates['Letter of Intent Due'] + six_months)
 
         # Default to a boring "Active" bar if we added no specific dates
         if not bar_added and dates['Start Date'] and dates['End Date']:
-            append_rows(normal_rows, truncated_rows, item,
-                    'Active', dates['Start Date'], dates['End Date'])
+            add('Active', dates['Start Date'], dates['End Date'])
 
+    return bars
 
-    preamble = """
+
+def build_chart(title, data_files, links="", show_warnings=True):
+    """
+    Build an HTML shell that fetches the given category data files and draws
+    them. Rows from several files are concatenated.
+    """
+    warnings_markup = ""
+    if show_warnings:
+        warnings_markup = """
+<h5>Date Parsing Warnings</h5>
+<div id="warnings"></div>
+"""
+
+    markup = """
 <h1>Near Future</h1>
 <div class="timeline-wrapper">
 <div id="near-timeline"></div>
@@ -199,13 +399,17 @@ def build_chart(category_name, chart_items, warnings, links=""):
 <div class="timeline-wrapper">
 <div id="study-timeline"></div>
 </div>
-
-<h5>Date Parsing Warnings</h5>
-""" + "<br/>".join(warnings) + """
-
+""" + warnings_markup + """
 <script type="text/javascript">
+  var dataFiles = """ + json.dumps(data_files) + """;
   google.charts.load("current", {packages:["timeline"]});
-  google.charts.setOnLoadCallback(drawCharts);
+  function toRows(data) {
+    return data.map(function (r) {
+      return [r[0], r[1], r[2],
+        new Date(r[3][0], r[3][1], r[3][2]),
+        new Date(r[4][0], r[4][1], r[4][2])];
+    });
+  }
   function drawChart(id, data, width) {
     var container = document.getElementById(id);
     var chart = new google.visualization.Timeline(container);
@@ -215,7 +419,7 @@ def build_chart(category_name, chart_items, warnings, links=""):
     dataTable.addColumn({ type: 'string', id: 'style', role: 'style' });
     dataTable.addColumn({ type: 'date', id: 'Start' });
     dataTable.addColumn({ type: 'date', id: 'End' });
-    dataTable.addRows(data);
+    dataTable.addRows(toRows(data));
     // set a padding value to cover the height of title and axis values
     var paddingHeight = 50;
     // set the height to be covered by the rows
@@ -225,20 +429,29 @@ def build_chart(category_name, chart_items, warnings, links=""):
 
     chart.draw(dataTable, { width: width, height: chartHeight });
   }
-  function drawCharts() {
-"""
-
-    ending = """
-    drawChart('near-timeline', near, 2000);
-    drawChart('study-timeline', all, 2000);
-  }
+  var loaded = Promise.all(dataFiles.map(function (f) {
+    return fetch(f).then(function (response) { return response.json(); });
+  }));
+  google.charts.setOnLoadCallback(function () {
+    loaded.then(function (files) {
+      var near = [], all = [], warnings = [];
+      files.forEach(function (data) {
+        near = near.concat(data.near);
+        all = all.concat(data.all);
+        warnings = warnings.concat(data.warnings);
+      });
+      drawChart('near-timeline', near, 2000);
+      drawChart('study-timeline', all, 2000);
+      var warningsDiv = document.getElementById('warnings');
+      if (warningsDiv) {
+        warningsDiv.innerText = warnings.join("\\n");
+      }
+    });
+  });
 </script>
 """
 
-    data1 = "var near = [{}];".format(",\n".join(truncated_rows))
-    data2 = "var all = [{}];".format(",\n".join(normal_rows))
-
-    return make_html(f"Chart for category {category_name}", links + preamble + data1 + data2 + ending)
+    return make_html(title, links + markup)
 
 
 def build_table(category, chart_items, links=""):
@@ -268,34 +481,56 @@ def build_table(category, chart_items, links=""):
     content.append(links)
     return make_html(f"Dates for category {category}", "\n".join(content))
 
+DATE_WORDY = re.compile(r'^\D{3}')
+DATE_YEAR_FIRST = re.compile(r'^\d{4}')
+DATE_YEAR = re.compile('^[0-9]{4}')
+
+@lru_cache(maxsize=None)
+def normalize_date(d):
+    """
+    Parse a raw template date value. Many pages share the same values, so
+    this is memoized on the raw string.
+
+    Returns a (datetime, problem) pair, where problem is None if it parsed
+    cleanly, "year" if we only found a year, or "unparseable" with no date.
+    """
+    try:
+        if DATE_WORDY.match(d) is not None:
+            pattern = "%B %d, %Y"
+        elif DATE_YEAR_FIRST.match(d) is not None:
+            pattern = "%Y/%m/%d"
+        else:
+            pattern = "%m/%d/%Y"
+        return datetime.strptime(d, pattern), None
+    except ValueError:
+        year = DATE_YEAR.match(d)
+        if year is not None:
+            return datetime(int(year.group(0)), 1, 1), "year"
+        return None, "unparseable"
+
 def fill_hash_dates(warnings, page, template, dates, key):
     if template.has(key):
         d = template.get(key).value.strip()
         if d == "":
             return
-        try:
-            if re.match(r'^\D{3}', d) is not None:
-                pattern = "%B %d, %Y"
-            elif re.match(r'^\d{4}', d) is not None:
-                pattern = "%Y/%m/%d"
-            else:
-                pattern = "%m/%d/%Y"
-            dates[key] = datetime.strptime(d, pattern)
-        except ValueError:
-            year = re.match('^[0-9]{4}', d)
-            if year is not None:
-                year = int(year.group(0))
-                warning = "Only found year {} for date {} on page {} from value '{}', guessing January 1".format(year, key, page, d)
-                warnings.append(warning)
-                logging.warning(warning)
-                dates[key] = datetime(year, 1, 1)
-            else:
-                warning = "Could not get {} for page {} from template value '{}'".format(key, page, d)
-                warnings.append(warning)
-                logging.warning(warning)
-
+        parsed, problem = normalize_date(d)
+        if problem == "year":
+            warning = "Only found year {} for date {} on page {} from value '{}', guessing January 1".format(parsed.year, key, page, d)
+            warnings.append(warning)
+            logging.warning(warning)
+        elif problem:
+            warning = "Could not get {} for page {} from template value '{}'".format(key, page, d)
+            warnings.append(warning)
+            logging.warning(warning)
+        if parsed:
+            dates[key] = parsed
+
+
+def run(mother, output_dir=None):
+    if not output_dir:
+        output_dir = DEFAULT_OUTPUT_DIR
+    os.makedirs(output_dir, exist_ok=True)
 
-def run(mother):
     chart_data = {}
     chart_warnings = {}
     def extract(category_name, date_fields):
@@ -321,36 +556,47 @@ def run(mother):
         chart_data[category_name], chart_warnings[category_name] = \
             extract(category_name, fields)
 
-    # Now we write the chart for each kind
+    # Now we write the data and pages for each kind. The pages themselves
+    # only change if the markup here does, the data files carry the rows.
 
     link_all_timelines = "<h2><a href='index.html'>Back to all timelines</a></h2>"
+    tables = {}
     for category_name, items in chart_data.items():
-        with open(f"/home/dfitch/pub_html/timeline/{category_name}.html", "w") as output:
-            chart_markup = build_chart(category_name, items, chart_warnings[category_name],
-                    link_all_timelines +
-                    f"<h2><a href='{category_name}_dates.html'>View {category_name} date report</a></h2>")
-            output.write(chart_markup, )
-
-        with open(f"/home/dfitch/pub_html/timeline/{category_name}_dates.html", "w") as output:
-            markup = build_table(category_name, items,
-                    link_all_timelines +
-                    f"<h2><a href='{category_name}.html'>View {category_name} timeline</a></h2>")
-            output.write(markup)
-
-    # Join dictionaries
-    all_items = {}
-    all_items.update(chart_data['Grant'])
-    all_items.update(chart_data['Project'])
-    all_items.update(chart_data['Study'])
-
-    # And finally the chart of everything joined together
-    chart_markup = build_chart("All", all_items, [],
+        table = make_bar_table(collect_bars(items))
+        tables[category_name] = table
+        write_data(output_dir, category_name, build_data(table, chart_warnings[category_name]))
+        write_static(output_dir, category_name, f"Static chart for category {category_name}", table,
+                link_all_timelines +
+                f"<h2><a href='{category_name}.html'>View interactive {category_name} timeline</a></h2>")
+
+        chart_markup = build_chart(f"Chart for category {category_name}",
+                [f"{category_name}.json"],
+                link_all_timelines +
+                f"<h2><a href='{category_name}_dates.html'>View {category_name} date report</a> | " +
+                f"<a href='{category_name}_static.html'>View static {category_name} timeline</a></h2>")
+        artifacts.write_if_changed(os.path.join(output_dir, f"{category_name}.html"),
+                chart_markup)
+
+        markup = build_table(category_name, items,
+                link_all_timelines +
+                f"<h2><a href='{category_name}.html'>View {category_name} timeline</a></h2>")
+        artifacts.write_if_changed(os.path.join(output_dir, f"{category_name}_dates.html"),
+                markup)
+
+    # And finally the chart of everything joined together, which just loads
+    # every category's data file
+    chart_markup = build_chart("Chart for category All",
+        [f"{category_name}.json" for category_name in ['Grant', 'Project', 'Study']],
         "<h2><a href='Grant.html'>View only grants</a> | " +
         "<a href='Project.html'>View only projects</a> | " +
-        "<a href='Study.html'>View only studies</a></h2>" +
+        "<a href='Study.html'>View only studies</a> | " +
+        "<a href='All_static.html'>View static timeline</a></h2>" +
         f"<h2><a href='{WIKI_URL}/Category:Grant'>Wiki grants listing</a> | " +
         f"<a href='{WIKI_URL}/Category:Project'>Wiki projects listing</a> | " +
-        f"<a href='{WIKI_URL}/Category:Study'>Wiki studies listing</a></h2>")
-    with open("/home/dfitch/pub_html/timeline/index.html", "w") as output:
-        output.write(chart_markup)
+        f"<a href='{WIKI_URL}/Category:Study'>Wiki studies listing</a></h2>",
+        show_warnings=False)
+    artifacts.write_if_changed(os.path.join(output_dir, "index.html"), chart_markup)
 
+    all_table = np.concatenate([tables[c] for c in ['Grant', 'Project', 'Study']])
+    write_static(output_dir, "All", "Static chart for all timelines", all_table,
+            "<h2><a href='index.html'>View interactive timeline</a></h2>")
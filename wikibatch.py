@@ -0,0 +1,51 @@
+import logging
+
+# MediaWiki takes up to 50 titles per query for normal accounts
+MAX_TITLES = 50
+
+def query_titles(wiki, titles, **params):
+    """
+    Run `action=query` for many titles at once, `MAX_TITLES` per request,
+    following continuations.
+
+    Yields (requested title, page dict) pairs. Page dicts for titles that
+    got normalized or redirected by the wiki are matched back to the title
+    we asked for. Props that continue across requests (like `linkshere`)
+    are merged into the same page dict.
+    """
+    titles = list(dict.fromkeys(titles))
+    for start in range(0, len(titles), MAX_TITLES):
+        chunk = titles[start:start + MAX_TITLES]
+        pages = {}
+        aliases = {}
+        continuation = {}
+        while True:
+            result = wiki.get('query', titles='|'.join(chunk), **params, **continuation)
+            query = result.get('query', {})
+            for n in query.get('normalized', []):
+                aliases[n['from']] = n['to']
+            for r in query.get('redirects', []):
+                aliases[r['from']] = r['to']
+            for page in query.get('pages', {}).values():
+                merged = pages.setdefault(page['title'], {})
+                for key, value in page.items():
+                    if isinstance(value, list):
+                        merged.setdefault(key, []).extend(value)
+                    else:
+                        merged[key] = value
+            if 'continue' in result:
+                continuation = result['continue']
+            else:
+                break
+
+        for title in chunk:
+            resolved = title
+            # Normalized then redirected is two hops
+            seen = set()
+            while resolved in aliases and not resolved in seen:
+                seen.add(resolved)
+                resolved = aliases[resolved]
+            if resolved in pages:
+                yield title, pages[resolved]
+            else:
+                logging.debug(f"No query result for title {title}")
@@ -0,0 +1,133 @@
+import os
+import re
+import json
+import time
+import logging
+
+whitespace_regex = re.compile(r'[\s_]+')
+
+# Redirects to redirects are rare, but don't loop forever on a cycle
+MAX_REDIRECT_HOPS = 5
+
+def normalize_title(title, namespaces=None, first_letter=True):
+    """
+    Turn a link target into the title MediaWiki would give the page:
+    drop any "#fragment" and leading colon, underscores and runs of
+    whitespace become one space, the namespace gets its canonical name and
+    the first letter of the title gets capitalized.
+
+    `namespaces` maps lowercased namespace names and aliases to canonical
+    names. Without it, anything before a colon is treated as part of the
+    title.
+    """
+    title = title.split("#", 1)[0]
+    title = whitespace_regex.sub(" ", title).strip().lstrip(":").strip()
+
+    namespace = None
+    if namespaces and ":" in title:
+        prefix, rest = title.split(":", 1)
+        prefix = prefix.strip().lower()
+        if prefix in namespaces:
+            namespace = namespaces[prefix]
+            title = rest.strip()
+
+    if first_letter and title:
+        title = title[0].upper() + title[1:]
+
+    if namespace:
+        return namespace + ":" + title
+    return title
+
+
+class TitleResolver:
+    """
+    Resolves wiki link targets to canonical page titles without asking the
+    wiki each time: normalizes them like MediaWiki does and follows
+    redirects, from a redirect map fetched in bulk and cached on disk.
+    """
+
+    def __init__(self, namespaces, redirects, first_letter=True, created=None):
+        self.namespaces = namespaces
+        self.redirects = redirects
+        self.first_letter = first_letter
+        self.created = created or time.time()
+
+
+    def normalize(self, title):
+        return normalize_title(title, self.namespaces, self.first_letter)
+
+
+    def resolve(self, title):
+        """
+        Normalize `title` and follow it through any redirects.
+        """
+        title = self.normalize(title)
+        for _ in range(MAX_REDIRECT_HOPS):
+            if not title in self.redirects:
+                break
+            title = self.redirects[title]
+        return title
+
+
+    @classmethod
+    def fetch(cls, wiki):
+        """
+        Build a resolver from the wiki's namespace names and every redirect
+        in the content namespaces, a page of 500 redirects per request.
+        """
+        info = wiki.get('query', meta='siteinfo', siprop='general|namespaces|namespacealiases')['query']
+        first_letter = info['general'].get('case', 'first-letter') == 'first-letter'
+        namespaces = {}
+        for ns_id, ns in info['namespaces'].items():
+            if ns['*']:
+                namespaces[ns['*'].lower()] = ns['*']
+                if ns.get('canonical'):
+                    namespaces[ns['canonical'].lower()] = ns['*']
+        local_names = {str(ns_id): ns['*'] for ns_id, ns in info['namespaces'].items()}
+        for alias in info.get('namespacealiases', []):
+            namespaces[alias['*'].lower()] = local_names[str(alias['id'])]
+
+        redirects = {}
+        for ns_id in info['namespaces'].keys():
+            # Negative namespaces (Special, Media) can't hold pages
+            if int(ns_id) < 0:
+                continue
+            continuation = {}
+            while True:
+                result = wiki.get('query', generator='allpages', gapnamespace=ns_id,
+                        gapfilterredir='redirects', gaplimit='max', redirects=1, **continuation)
+                for r in result.get('query', {}).get('redirects', []):
+                    redirects[r['from']] = r['to']
+                if 'continue' in result:
+                    continuation = result['continue']
+                else:
+                    break
+        logging.info(f"Fetched {len(redirects)} wiki redirects")
+        return cls(namespaces, redirects, first_letter)
+
+
+    def is_fresh(self, max_age):
+        return time.time() - self.created < max_age
+
+
+    def save(self, path):
+        data = {
+            'created': self.created,
+            'first_letter': self.first_letter,
+            'namespaces': self.namespaces,
+            'redirects': self.redirects,
+        }
+        with open(path, 'w') as f:
+            json.dump(data, f)
+
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a saved resolver, or return None if there isn't one.
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data['namespaces'], data['redirects'], data['first_letter'], data['created'])